@@ -7,6 +7,10 @@ from serializers.fields import (
     RelatedField,
     PrimaryKeyRelatedField,
     NaturalKeyRelatedField,
+    GenericForeignKeyField,
+    BatchField,
+    AggregateField,
+    Base64FileField,
 )
 from serializers.fixture_serializer import FixtureSerializer
 
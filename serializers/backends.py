@@ -0,0 +1,257 @@
+"""
+Pluggable JSON encoding and decoding.
+
+The JSON renderer and parser use a backend, chosen with the serializer's
+`json_backend` option, or else the `SERIALIZERS_JSON_BACKEND` setting.
+An adapter is provided for simplejson and its C speedups.  If the library
+for a backend isn't installed, the standard library backend is used.
+"""
+from collections import OrderedDict
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+from serializers.utils import DjangoJSONEncoder, Base64Payload, is_mapping
+import datetime
+import decimal
+import json
+import types
+
+
+# The string encoder used by `DjangoJSONEncoder`.
+_encode_string = json.encoder.encode_basestring_ascii
+
+
+def _encode_float(value):
+    # Matches the standard library's encoding of floats.
+    if value != value:
+        return 'NaN'
+    elif value == float('inf'):
+        return 'Infinity'
+    elif value == float('-inf'):
+        return '-Infinity'
+    return repr(value)
+
+
+class JSONBackend(object):
+    """
+    Encodes JSON with `DjangoJSONEncoder`, and decodes it with the standard
+    library's json module.  This is the default backend.
+
+    Compact lists of objects, such as serialized querysets, are encoded by
+    concatenating the pre-encoded `"key": ` fragments for each shape of
+    object with encoded values, rather than by the generic encoder.
+    """
+    def __init__(self):
+        self.schemas = {}
+        self.encoders = {}
+        default = DjangoJSONEncoder().default
+        encode_default = lambda value: _encode_string(default(value))
+        self.value_encoders = {
+            unicode: _encode_string,
+            str: _encode_string,
+            int: str,
+            long: str,
+            float: _encode_float,
+            bool: lambda value: value and 'true' or 'false',
+            types.NoneType: lambda value: 'null',
+            datetime.datetime: encode_default,
+            datetime.date: encode_default,
+            datetime.time: encode_default,
+            decimal.Decimal: encode_default,
+        }
+
+    def iterencode(self, obj, indent=None, sort_keys=False):
+        """
+        Encode `obj`, yielding the output a chunk at a time.  Lists and
+        generators are encoded an item at a time, and file payloads are
+        streamed in place of the placeholder strings emitted for them.
+        """
+        if is_mapping(obj) or not hasattr(obj, '__iter__'):
+            return self.iterencode_item(obj, indent, sort_keys)
+        return self.iterencode_list(obj, indent, sort_keys)
+
+    def list_separators(self, indent=None):
+        """
+        Return the strings written before the first item of a non-empty list,
+        between its items, and after its last item.
+        """
+        if indent is None:
+            return '[', ', ', ']'
+        newline = '\n' + ' ' * indent
+        return '[' + newline, ', ' + newline, '\n]'
+
+    def iterencode_list(self, items, indent=None, sort_keys=False):
+        start, separator, end = self.list_separators(indent)
+        empty = True
+        for item in items:
+            yield separator if not empty else start
+            empty = False
+            for chunk in self.iterencode_item(item, indent, sort_keys, level=1):
+                yield chunk
+        yield '[]' if empty else end
+
+    def get_encoder(self, indent=None, sort_keys=False):
+        try:
+            return self.encoders[(indent, sort_keys)]
+        except KeyError:
+            encoder = DjangoJSONEncoder(indent=indent, sort_keys=sort_keys)
+            encoder.payloads = {}
+            encoder.lazy_lists = True
+            self.encoders[(indent, sort_keys)] = encoder
+            return encoder
+
+    def iterencode_item(self, obj, indent=None, sort_keys=False, level=0):
+        """
+        Encode a single value, indented as an item of a list nested `level`
+        lists deep.  Objects without indentation are encoded from the
+        pre-encoded key fragments.
+        """
+        encoder = self.get_encoder(indent, sort_keys)
+        if indent is None and is_mapping(obj) and obj:
+            chunks = self.iterencode_row(encoder, obj, sort_keys)
+        else:
+            chunks = encoder.iterencode(obj)
+        newline = None
+        if indent is not None and level:
+            newline = '\n' + ' ' * (indent * level)
+        for chunk in chunks:
+            payload = encoder.payloads.pop(chunk, None)
+            if payload is None:
+                if newline is not None:
+                    chunk = chunk.replace('\n', newline)
+                yield chunk
+                continue
+            yield '"'
+            for data in payload.chunks():
+                yield data
+            yield '"'
+
+    def get_schema(self, keys):
+        """
+        Return the encoded `"key": ` fragments for objects with the given
+        keys, or None if any of the keys aren't strings.
+        """
+        try:
+            return self.schemas[keys]
+        except KeyError:
+            pass
+        if [key for key in keys if not isinstance(key, basestring)]:
+            schema = None
+        else:
+            schema = ['%s%s: ' % (index and ', ' or '{', _encode_string(key))
+                      for index, key in enumerate(keys)]
+        self.schemas[keys] = schema
+        return schema
+
+    def iterencode_row(self, encoder, row, sort_keys):
+        keys = row.keys()
+        if sort_keys:
+            keys.sort()
+        schema = self.get_schema(tuple(keys))
+        if schema is None:
+            for chunk in encoder.iterencode(row):
+                yield chunk
+            return
+
+        value_encoders = self.value_encoders
+        parts = []
+        for fragment, key in zip(schema, keys):
+            value = row[key]
+            encode = value_encoders.get(type(value))
+            if encode is not None:
+                parts.append(fragment + encode(value))
+                continue
+            # Nested objects, lists and payloads use the generic encoder.
+            parts.append(fragment)
+            yield ''.join(parts)
+            parts = []
+            for chunk in encoder.iterencode(value):
+                yield chunk
+        parts.append('}')
+        yield ''.join(parts)
+
+    def load(self, stream):
+        return json.load(stream)
+
+
+class LibraryJSONBackend(JSONBackend):
+    """
+    Base class for adapters to other JSON libraries.
+
+    Top level lists are still streamed, with each item encoded in one call
+    to the library.  Values the library can't encode are first converted
+    with the same rules as `DjangoJSONEncoder`.  Indented output falls back
+    to `DjangoJSONEncoder`, so that it is formatted as usual.
+    """
+    module_name = None
+
+    def __init__(self):
+        super(LibraryJSONBackend, self).__init__()
+        self.module = import_module(self.module_name)
+        self.encoder = DjangoJSONEncoder()
+
+    def dumps(self, obj, sort_keys=False):
+        raise NotImplementedError()
+
+    def prepare(self, obj):
+        """
+        Convert `obj` into types the library can encode.
+        """
+        if isinstance(obj, (basestring, int, long, float, bool)) or obj is None:
+            return obj
+        elif is_mapping(obj):
+            return OrderedDict([(key, self.prepare(value)) for key, value in obj.iteritems()])
+        elif isinstance(obj, Base64Payload):
+            return str(obj)
+        elif hasattr(obj, '__iter__'):
+            return [self.prepare(item) for item in obj]
+        return self.prepare(self.encoder.default(obj))
+
+    def iterencode_item(self, obj, indent=None, sort_keys=False, level=0):
+        if indent is not None:
+            return super(LibraryJSONBackend, self).iterencode_item(obj, indent, sort_keys, level)
+        return iter([self.dumps(self.prepare(obj), sort_keys)])
+
+    def load(self, stream):
+        return self.module.loads(stream.read())
+
+
+class SimpleJSONBackend(LibraryJSONBackend):
+    """
+    Uses simplejson and its C speedups.  simplejson supports a `default`
+    hook and ordered dicts, so values don't need to be prepared.  Decimals
+    are encoded as strings, as they are by `DjangoJSONEncoder`.
+    """
+    module_name = 'simplejson'
+
+    def prepare(self, obj):
+        return obj
+
+    def dumps(self, obj, sort_keys=False):
+        return self.module.dumps(obj, sort_keys=sort_keys, default=self.encoder.default,
+                                 use_decimal=False, iterable_as_array=True)
+
+
+JSON_BACKENDS = {
+    'json': JSONBackend,
+    'simplejson': SimpleJSONBackend,
+}
+
+
+def get_json_backend(backend=None):
+    """
+    Return an instance of the given backend, which may be a backend class,
+    or the name of one of the built in backends.  Defaults to the backend
+    named by the `SERIALIZERS_JSON_BACKEND` setting.
+    """
+    if backend is None:
+        backend = getattr(settings, 'SERIALIZERS_JSON_BACKEND', 'json')
+    if isinstance(backend, basestring):
+        try:
+            backend = JSON_BACKENDS[backend]
+        except KeyError:
+            raise ImproperlyConfigured('Unknown JSON backend %r' % backend)
+    try:
+        return backend()
+    except ImportError:
+        return JSONBackend()
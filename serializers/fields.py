@@ -1,24 +1,28 @@
 import datetime
+from ast import literal_eval
 from django.utils.encoding import is_protected_type, smart_unicode
 from django.core import validators
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.conf import settings
-from django.db import DEFAULT_DB_ALIAS
+from django.db import DEFAULT_DB_ALIAS, models
 from django.db.models.related import RelatedObject
 from django.utils import timezone
+from django.utils.datastructures import SortedDict
 from django.utils.dateparse import parse_date, parse_datetime
 from django.utils.translation import ugettext_lazy as _
-from serializers.utils import is_simple_callable
+from serializers.utils import is_simple_callable, Base64Payload, Base64ContentFile
 import warnings
 
 
 class Field(object):
     creation_counter = 0
 
-    def __init__(self, source=None, readonly=False):
+    def __init__(self, source=None, readonly=False, io_bound=False):
         self.source = source
         self.readonly = readonly
+        self.io_bound = io_bound
         self.parent = None
+        self.resolved = {}
         self.creation_counter = Field.creation_counter
         Field.creation_counter += 1
 
@@ -35,6 +39,37 @@ class Field(object):
         if model_field:
             self.model_field = model_field
 
+    def get_db(self, obj=None):
+        """
+        Return the database alias to read from.  This is the root serializer's
+        `using` option if it was given, or else the database that `obj` was
+        loaded from.
+        """
+        using = getattr(getattr(self, 'root', None) or self, 'using', None)
+        if using is None and obj is not None:
+            return obj._state.db
+        return using
+
+    def prefetch(self, objects, field_name):
+        """
+        Called with each chunk of objects before `field_to_native` is called
+        for any of them.  Override this to batch up any per-object work.
+
+        If the field is I/O bound, its values are fetched for the whole chunk
+        at once, on the root serializer's pool of `Meta.io_workers` threads.
+        """
+        if not self.io_bound or self.source == '*' or self.parent.is_record(objects[0]):
+            return
+
+        def resolve(obj):
+            value = getattr(obj, self.source or field_name)
+            if is_simple_callable(value):
+                value = value()
+            return value
+
+        values = self.root.get_io_pool().map(resolve, objects)
+        self.resolved = dict([(id(obj), (obj, value)) for obj, value in zip(objects, values)])
+
     def field_from_native(self, data, field_name, into):
         """
         Given a dictionary and a field name, updates the dictionary `into`,
@@ -56,8 +91,15 @@ class Field(object):
     def from_native(self, value):
         """
         Reverts a simple representation back to the field's value.
+
+        Empty strings, and the string 'None', are treated as None for
+        nullable model fields that don't allow empty strings, as formats such
+        as CSV can't tell them apart.
         """
         if hasattr(self, 'model_field'):
+            if (value in ('', 'None') and self.model_field.null and
+                not self.model_field.empty_strings_allowed):
+                return None
             try:
                 return self.model_field.rel.to._meta.get_field(self.model_field.rel.field_name).to_python(value)
             except:
@@ -73,6 +115,10 @@ class Field(object):
             return self.to_native(obj)
 
         self.obj = obj  # Need to hang onto this in the case of model fields
+        if self.io_bound:
+            resolved, value = self.resolved.pop(id(obj), (None, None))
+            if resolved is obj:
+                return self.to_native(value)
         if hasattr(self, 'model_field'):
             return self.to_native(self.model_field._get_val_from_obj(obj))
 
@@ -87,7 +133,7 @@ class Field(object):
 
         if is_protected_type(value):
             return value
-        elif hasattr(self, 'model_field'):
+        elif hasattr(self, 'model_field') and getattr(self, 'obj', None) is not None:
             return self.model_field.value_to_string(self.obj)
         return smart_unicode(value)
 
@@ -112,11 +158,45 @@ class RelatedField(Field):
     """
 
     def field_to_native(self, obj, field_name):
-        obj = getattr(obj, field_name)
+        obj = self.get_related_object(obj, field_name)
         if obj.__class__.__name__ in ('RelatedManager', 'ManyRelatedManager'):
-            return [self.to_native(item) for item in obj.all()]
+            return [self.to_native(item) for item in self.get_related_queryset(obj)]
         return self.to_native(obj)
 
+    def get_related_object(self, obj, field_name):
+        """
+        Return the related object or manager for `field_name`.  Forward
+        relations are fetched from the `using` database, if one was given.
+        A reverse one-to-one relation without a related object, such as a
+        parent model instance without a child, is None.
+        """
+        model_field = getattr(self, 'model_field', None)
+        using = self.get_db()
+        if (using is None or using == obj._state.db or
+            not isinstance(model_field, models.ForeignKey) or
+            model_field.name != (self.source or field_name)):
+            try:
+                return getattr(obj, field_name)
+            except ObjectDoesNotExist:
+                return None
+
+        value = getattr(obj, model_field.attname)
+        if value is None:
+            return None
+        manager = model_field.rel.to._base_manager.using(using)
+        return manager.get(**{model_field.rel.field_name: value})
+
+    def get_related_queryset(self, manager):
+        """
+        Return all the objects of a related manager, read from the `using`
+        database, if one was given.
+        """
+        queryset = manager.all()
+        using = self.get_db()
+        if using is not None:
+            queryset = queryset.using(using)
+        return queryset
+
     def attributes(self):
         try:
             return {
@@ -144,6 +224,7 @@ class PrimaryKeyRelatedField(RelatedField):
 
     error_messages = {
         'invalid': _(u"'%s' value must be an integer."),
+        'invalid_list': _(u"'%s' value must be a list of primary keys."),
     }
 
     def to_native(self, pk):
@@ -161,21 +242,37 @@ class PrimaryKeyRelatedField(RelatedField):
             field = obj._meta.get_field_by_name(field_name)[0]
             obj = getattr(obj, field_name)
             if obj.__class__.__name__ == 'RelatedManager':
-                return [self.to_native(item.pk) for item in obj.all()]
+                return [self.to_native(item.pk) for item in self.get_related_queryset(obj)]
             elif isinstance(field, RelatedObject):
                 return self.to_native(obj.pk)
             raise
         if obj.__class__.__name__ == 'ManyRelatedManager':
-            return [self.to_native(item.pk) for item in obj.all()]
+            return [self.to_native(item.pk) for item in self.get_related_queryset(obj)]
         return self.to_native(obj)
 
     def field_from_native(self, data, field_name, into):
         value = data.get(field_name)
+        if (isinstance(value, basestring) and
+            isinstance(getattr(self, 'model_field', None), models.ManyToManyField)):
+            value = self.parse_list(value)
         if hasattr(value, '__iter__'):
             into[field_name] = [self.from_native(item) for item in value]
         else:
             into[field_name + '_id'] = self.from_native(value)
 
+    def parse_list(self, value):
+        """
+        Parse a list of pks from a string, such as the cells that the CSV
+        renderer writes for many-to-many fields.  Eg. '[1, 2]'
+        """
+        try:
+            pks = literal_eval(value)
+        except (ValueError, SyntaxError):
+            pks = None
+        if not isinstance(pks, (list, tuple)):
+            raise ValidationError(self.error_messages['invalid_list'] % value)
+        return pks
+
 
 class NaturalKeyRelatedField(RelatedField):
     """
@@ -193,12 +290,218 @@ class NaturalKeyRelatedField(RelatedField):
         into[self.model_field.attname] = self.from_native(value)
 
     def from_native(self, value):
-        # TODO: Support 'using' : db = options.pop('using', DEFAULT_DB_ALIAS)
         manager = self.model_field.rel.to._default_manager
-        manager = manager.db_manager(DEFAULT_DB_ALIAS)
+        manager = manager.db_manager(self.get_db() or DEFAULT_DB_ALIAS)
         return manager.get_by_natural_key(*value).pk
 
 
+class GenericForeignKeyField(RelatedField):
+    """
+    Serializes a generic foreign key to the related object's model name and
+    primary key.  Eg. {'model': 'auth.user', 'pk': 1}
+
+    The related objects for each chunk of objects are fetched with a single
+    query per content type, rather than one query per object.
+    """
+
+    def get_descriptor(self, cls, field_name):
+        return getattr(cls, self.source or field_name)
+
+    def prefetch(self, objects, field_name):
+        from django.contrib.contenttypes.models import ContentType
+
+        if self.parent.is_record(objects[0]):
+            return
+        gfk = self.get_descriptor(objects[0].__class__, field_name)
+        ct_attname = objects[0]._meta.get_field(gfk.ct_field).get_attname()
+
+        groups = {}
+        for obj in objects:
+            ct_id = getattr(obj, ct_attname)
+            if ct_id is not None and not hasattr(obj, gfk.cache_attr):
+                groups.setdefault((self.get_db(obj), ct_id), []).append(obj)
+
+        for (db, ct_id), group in groups.items():
+            # ContentType lookups use the content types framework's own
+            # process-wide cache, so only the related objects hit the database.
+            content_type = ContentType.objects.db_manager(db).get_for_id(ct_id)
+            model = content_type.model_class()
+            to_python = model._meta.pk.to_python
+            pks = [to_python(getattr(obj, gfk.fk_field)) for obj in group]
+            related = model._base_manager.using(db).in_bulk(pks)
+            for obj, pk in zip(group, pks):
+                setattr(obj, gfk.cache_attr, related.get(pk))
+
+    def field_to_native(self, obj, field_name):
+        if self.parent.is_record(obj):
+            return self.record_to_native(obj, field_name)
+        return self.to_native(getattr(obj, self.source or field_name))
+
+    def record_to_native(self, record, field_name):
+        """
+        Records, such as rows of a values() queryset, only hold the content
+        type and object id, which are serialized without fetching the
+        related object.
+        """
+        from django.contrib.contenttypes.models import ContentType
+
+        model = self.parent.opts.model
+        gfk = self.get_descriptor(model, field_name)
+        ct_field = model._meta.get_field(gfk.ct_field)
+        for key in (ct_field.name, ct_field.attname):
+            if key in record:
+                ct_id = record[key]
+                break
+        else:
+            raise ValueError("Record has no %r value for generic foreign key %r"
+                             % (ct_field.name, field_name))
+        if ct_id is None:
+            return None
+        content_type = ContentType.objects.get_for_id(ct_id)
+        return SortedDict((
+            ('model', smart_unicode(content_type.model_class()._meta)),
+            ('pk', record[gfk.fk_field])
+        ))
+
+    def to_native(self, obj):
+        if obj is None:
+            return None
+        return SortedDict((
+            ('model', smart_unicode(obj._meta)),
+            ('pk', obj.pk)
+        ))
+
+    def from_native(self, value):
+        if value is None:
+            return None
+        model = models.get_model(*value['model'].split('.'))
+        # The generic foreign key only needs the model and pk of the related
+        # object, so there's no need to fetch it from the database.
+        return model(pk=model._meta.pk.to_python(value['pk']))
+
+
+class BatchField(Field):
+    """
+    A field whose values are computed for a whole chunk of objects at once.
+
+    `resolver` is called with a list of objects, and should return a list
+    of values for those objects, in the same order.  It may be a callable,
+    or the name of a method on the serializer.  Each value may be a simple
+    value, or a list of simple values.  A `ValueError` is raised if the
+    resolver returns the wrong number of values.
+    """
+
+    def __init__(self, resolver, *args, **kwargs):
+        self.resolver = resolver
+        super(BatchField, self).__init__(*args, **kwargs)
+
+    def get_resolver(self):
+        if isinstance(self.resolver, basestring):
+            return getattr(self.parent, self.resolver)
+        return self.resolver
+
+    def prefetch(self, objects, field_name):
+        values = list(self.get_resolver()(objects))
+        if len(values) != len(objects):
+            raise ValueError('Batch resolver returned %d values for %d objects'
+                             % (len(values), len(objects)))
+        self.resolved = dict([(id(obj), (obj, value)) for obj, value in zip(objects, values)])
+
+    def field_to_native(self, obj, field_name):
+        resolved, value = self.resolved.pop(id(obj), (None, None))
+        if resolved is not obj:
+            # Not part of a chunk, eg. when serializing a single object.
+            self.prefetch([obj], field_name)
+            resolved, value = self.resolved.pop(id(obj))
+        self.obj = obj
+        return self.to_native(value)
+
+    def to_native(self, value):
+        if isinstance(value, (list, tuple)):
+            return [super(BatchField, self).to_native(item) for item in value]
+        return super(BatchField, self).to_native(value)
+
+
+class AggregateField(Field):
+    """
+    Serializes an aggregate over each model instance's related objects.
+    Eg. AggregateField(Count('tags'))
+
+    When a `ModelSerializer` serializes a queryset, the aggregate is added
+    to the queryset with `.annotate()`, so the values arrive with the main
+    query.  Otherwise each value is aggregated with a query of its own.
+    `values()` querysets are only annotated if they include the primary key.
+    """
+
+    def __init__(self, expression, *args, **kwargs):
+        self.expression = expression
+        kwargs.setdefault('readonly', True)
+        super(AggregateField, self).__init__(*args, **kwargs)
+
+    def field_to_native(self, obj, field_name):
+        name = self.source or field_name
+        if isinstance(obj, dict):
+            if name not in obj:
+                raise ValueError('Record has no %r value.  values() querysets must '
+                                 'include the primary key to be annotated.' % name)
+            return self.to_native(obj[name])
+        if name not in obj.__dict__:
+            queryset = obj.__class__._default_manager.using(self.get_db(obj))
+            value = queryset.filter(pk=obj.pk).aggregate(**{name: self.expression})[name]
+            setattr(obj, name, value)
+        return self.to_native(obj.__dict__[name])
+
+
+class Base64FileField(Field):
+    """
+    Serializes a file field to the file's name and its base64 encoded
+    contents.  Eg. {'name': 'docs/report.txt', 'content': 'aGVsbG8='}
+
+    The contents are read from storage and encoded in chunks of `chunk_size`
+    bytes as the output is rendered, and are decoded back into storage in
+    chunks when deserializing.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.chunk_size = kwargs.pop('chunk_size', 3 * 2 ** 14)
+        self.storage = kwargs.pop('storage', None)
+        super(Base64FileField, self).__init__(*args, **kwargs)
+
+    def get_storage(self):
+        if self.storage is not None:
+            return self.storage
+        if hasattr(self, 'model_field'):
+            return self.model_field.storage
+        from django.core.files.storage import default_storage
+        return default_storage
+
+    def field_from_native(self, data, field_name, into):
+        # Declared fields are only matched up with their model field when
+        # serializing, but we need the model field's storage to restore into.
+        model = getattr(self.parent.opts, 'model', None)
+        if not hasattr(self, 'model_field') and model is not None:
+            self.model_field = model._meta.get_field(self.source or field_name)
+        super(Base64FileField, self).field_from_native(data, field_name, into)
+
+    def to_native(self, value):
+        if not value:
+            return super(Base64FileField, self).to_native(value)
+        storage = getattr(value, 'storage', None) or self.get_storage()
+        name = getattr(value, 'name', value)
+        return SortedDict((
+            ('name', name),
+            ('content', Base64Payload(storage, name, self.chunk_size))
+        ))
+
+    def from_native(self, value):
+        if not isinstance(value, dict):
+            return super(Base64FileField, self).from_native(value)
+        content = Base64ContentFile(value['content'], value['name'])
+        # Storage may choose a different name if the file already exists,
+        # so return the name the contents were actually saved under.
+        return self.get_storage().save(value['name'], content)
+
+
 class BooleanField(Field):
     error_messages = {
         'invalid': _(u"'%s' value must be either True or False."),
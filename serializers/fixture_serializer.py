@@ -3,6 +3,7 @@ from django.db import models
 from django.utils.datastructures import SortedDict
 from django.utils.encoding import smart_unicode
 from serializers import Field, PrimaryKeyRelatedField, NaturalKeyRelatedField
+from serializers import Base64FileField
 from serializers import Serializer
 from serializers.renderers import (
     JSONRenderer,
@@ -11,6 +12,7 @@ from serializers.renderers import (
 )
 from serializers.parsers import (
     JSONParser,
+    YAMLParser,
     DumpDataXMLParser
 )
 from serializers.utils import DictWithMetadata
@@ -58,6 +60,8 @@ class FixtureFields(Serializer):
                 field = FixtureSerializer()
             elif model_field.rel:
                 field = self._nk_or_pk_field(serialize, data, model_field)
+            elif isinstance(model_field, models.FileField):
+                field = self._file_field(serialize, data, model_field)
             else:
                 field = Field()
             field.initialize(parent=self, model_field=model_field)
@@ -75,6 +79,15 @@ class FixtureFields(Serializer):
             return NaturalKeyRelatedField()
         return PrimaryKeyRelatedField()
 
+    def _file_field(self, serialize, data, model_field):
+        """
+        Determine if file contents should be embedded, or just the file name.
+        """
+        if ((serialize and self.root.embed_files) or
+            not serialize and isinstance(data.get(model_field.name), dict)):
+            return Base64FileField()
+        return Field()
+
 
 class FixtureSerializer(Serializer):
     """
@@ -97,7 +110,8 @@ class FixtureSerializer(Serializer):
         }
         parser_classes = {
             'xml': DumpDataXMLParser,
-            'json': JSONParser
+            'json': JSONParser,
+            'yaml': YAMLParser,
         }
 
     def serialize(self, *args, **kwargs):
@@ -105,10 +119,12 @@ class FixtureSerializer(Serializer):
         Override default behavior slightly:
 
         1. Add 'use_natural_keys' option to switch between PK and NK relations.
-        2. The 'fields' and 'exclude' options should apply to the
+        2. Add 'embed_files' option to include the contents of file fields.
+        3. The 'fields' and 'exclude' options should apply to the
            'FixtureFields' child serializer, not to the root serializer.
         """
         self.use_natural_keys = kwargs.pop('use_natural_keys', False)
+        self.embed_files = kwargs.pop('embed_files', False)
 
         # TODO: Actually, this is buggy - fields/exclude will be retained as
         # state between subsequant calls to serialize()
@@ -1,69 +1,201 @@
-import json
-from xml.dom import pulldom
+import csv
+from xml.parsers import expat
 from django.core.serializers.base import DeserializationError
+from serializers.backends import get_json_backend
+from serializers.utils import YAMLLoader
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
 
 class JSONParser(object):
-    def parse(self, stream):
+    def parse(self, stream, **opts):
+        backend = get_json_backend(opts.pop('json_backend', None))
         try:
-            return json.load(stream)
+            return backend.load(stream)
         except Exception as e:
             # Map to deserializer error
             raise DeserializationError(e)
 
 
-class DumpDataXMLParser(object):
-    def parse(self, stream):
-        event_stream = pulldom.parse(stream)
-        for event, node in event_stream:
-            if event == "START_ELEMENT" and node.nodeName == "object":
-                event_stream.expandNode(node)
-                yield self._handle_object(node)
+class YAMLParser(object):
+    """
+    Parse YAML, using LibYAML if it is installed.
 
-    def _handle_object(self, node):
-        ret = {}
+    If the document is a list, its items are parsed and yielded one at a
+    time as the stream is read, rather than loading the whole document.
+    """
+    def parse(self, stream, **opts):
+        loader = YAMLLoader(stream)
+        try:
+            loader.get_event()
+            if loader.check_event(yaml.StreamEndEvent):
+                loader.dispose()
+                return None
+            loader.get_event()
+            if not loader.check_event(yaml.SequenceStartEvent):
+                data = loader.construct_document(loader.compose_node(None, None))
+                loader.dispose()
+                return data
+            loader.get_event()
+        except yaml.YAMLError as e:
+            loader.dispose()
+            raise DeserializationError(e)
+        return self.parse_items(loader)
+
+    def parse_items(self, loader):
+        try:
+            while not loader.check_event(yaml.SequenceEndEvent):
+                yield loader.construct_document(loader.compose_node(None, None))
+        except yaml.YAMLError as e:
+            raise DeserializationError(e)
+        finally:
+            loader.dispose()
+
+
+class CSVParser(object):
+    """
+    Parse CSV with a header row, such as the output of `CSVRenderer`.
 
-        if node.hasAttribute("pk"):
-            ret['pk'] = node.getAttribute('pk')
-        else:
-            ret['pk'] = None
-        ret['model'] = node.getAttribute('model')
-
-        fields = {}
-        for field_node in node.getElementsByTagName("field"):
-            # If the field is missing the name attribute, bail
-            name = field_node.getAttribute("name")
-            rel = field_node.getAttribute("rel")
-            if not name:
-                raise DeserializationError("<field> node is missing the 'name' attribute")
-
-            if field_node.getElementsByTagName('None'):
-                value = None
-            elif rel == 'ManyToManyRel':
-                value = [n.getAttribute('pk') for n in field_node.getElementsByTagName('object')]
-            elif field_node.getElementsByTagName('natural'):
-                value = [getInnerText(n).strip() for n in field_node.getElementsByTagName('natural')]
-            else:
-                value = getInnerText(field_node).strip()
-
-            fields[name] = value
-
-        ret['fields'] = fields
+    Rows are read from the stream lazily, and yielded as dicts of unicode
+    strings.  Dotted column names, such as `author.name`, are restored
+    into nested dicts.  Cells are left as strings, as only the fields they
+    are deserialized by know whether eg. 'None' or '[1, 2]' is a string.
+    """
+
+    def parse(self, stream, **opts):
+        reader = csv.reader(stream)
+        try:
+            header = reader.next()
+            paths = [tuple(name.decode('utf-8').split('.')) for name in header]
+            for row in reader:
+                yield self.unflatten(paths, row)
+        except StopIteration:
+            return
+        except (csv.Error, UnicodeDecodeError) as e:
+            raise DeserializationError(e)
 
+    def unflatten(self, paths, row):
+        ret = {}
+        for path, value in zip(paths, row):
+            value = value.decode('utf-8')
+            target = ret
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
         return ret
 
 
-def getInnerText(node):
+class DumpDataXMLParser(object):
     """
-    Get all the inner text of a DOM node (recursively).
+    Parse XML in dumpdata format.
+
+    The document is read `buffer_size` bytes at a time, and each `<object>`
+    is built into a dict directly from the parser's events, and yielded as
+    soon as it has been closed.
     """
-    # inspired by http://mail.python.org/pipermail/xml-sig/2005-March/011022.html
-    inner_text = []
-    for child in node.childNodes:
-        if child.nodeType == child.TEXT_NODE or child.nodeType == child.CDATA_SECTION_NODE:
-            inner_text.append(child.data)
-        elif child.nodeType == child.ELEMENT_NODE:
-            inner_text.extend(getInnerText(child))
-        else:
-            pass
-    return u"".join(inner_text)
+    buffer_size = 2 ** 16
+
+    def parse(self, stream):
+        self.records = []
+        self.record = None
+        self.field = None
+        self.depth = 0
+        self.elements = []
+        self.collectors = []
+
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.CharacterDataHandler = self.characters
+        parser.buffer_text = True
+
+        final = False
+        while not final:
+            data = stream.read(self.buffer_size)
+            final = not data
+            try:
+                parser.Parse(data, final)
+            except expat.ExpatError as e:
+                raise DeserializationError(e)
+            records, self.records = self.records, []
+            for record in records:
+                yield record
+
+    def start_element(self, name, attrs):
+        self.depth += 1
+        collectors = []
+
+        if self.field is not None:
+            field = self.field
+            if name == 'None':
+                field['none'] = True
+            elif name == 'object':
+                field['pks'].append(attrs.get('pk', u''))
+            if name == 'natural':
+                collectors.append([])
+                field['naturals'].append(collectors[-1])
+            if self.depth == field['depth'] + 1:
+                collectors.append([])
+                field['children'].append((name, collectors[-1]))
+
+        elif self.record is not None:
+            if name == 'field':
+                if not attrs.get('name'):
+                    raise DeserializationError("<field> node is missing the 'name' attribute")
+                collectors.append([])
+                self.field = {
+                    'name': attrs['name'],
+                    'rel': attrs.get('rel', u''),
+                    'depth': self.depth,
+                    'text': collectors[-1],
+                    'none': False,
+                    'pks': [],
+                    'naturals': [],
+                    'children': [],
+                }
+
+        elif name == 'object':
+            self.record = {
+                'pk': attrs.get('pk'),
+                'model': attrs.get('model', u''),
+                'fields': {},
+                'depth': self.depth
+            }
+
+        self.elements.append(len(collectors))
+        self.collectors.extend(collectors)
+
+    def end_element(self, name):
+        count = self.elements.pop()
+        if count:
+            del self.collectors[-count:]
+
+        if self.field is not None and self.depth == self.field['depth']:
+            self.record['fields'][self.field['name']] = self.field_value(self.field)
+            self.field = None
+        elif self.record is not None and self.depth == self.record['depth']:
+            del self.record['depth']
+            self.records.append(self.record)
+            self.record = None
+        self.depth -= 1
+
+    def characters(self, data):
+        for collector in self.collectors:
+            collector.append(data)
+
+    def field_value(self, field):
+        if field['none']:
+            return None
+        elif field['rel'] == 'ManyToManyRel':
+            return field['pks']
+        elif field['naturals']:
+            return [u''.join(text).strip() for text in field['naturals']]
+        elif field['children']:
+            return dict([(name, u''.join(text).strip()) for name, text in field['children']])
+        return u''.join(field['text']).strip()
+
+
+if not yaml:
+    YAMLParser = None
@@ -1,55 +1,286 @@
+import csv
 import datetime
-from django.utils import simplejson as json
+import itertools
+import re
+import types
+from StringIO import StringIO
 from django.utils.encoding import smart_unicode
-from django.utils.html import urlize
-from django.utils.xmlutils import SimplerXMLGenerator
-from serializers.utils import SafeDumper, DictWriter, DjangoJSONEncoder
+from django.utils.html import escape, urlize
+from serializers.utils import SafeDumper, CSafeDumper, XMLWriter
+from serializers.utils import Base64Payload, is_mapping
+from serializers.backends import get_json_backend
 try:
     import yaml
 except ImportError:
     yaml = None
 
 
+def _is_list(obj):
+    return hasattr(obj, '__iter__') and not is_mapping(obj)
+
+
+def _get_path(item, path):
+    """
+    Return the value at a path of keys into nested objects, or an empty
+    string if the path is missing.
+    """
+    for key in path:
+        if not is_mapping(item) or key not in item:
+            return u''
+        item = item[key]
+    return item
+
+
 class BaseRenderer(object):
     """
     Defines the base interface that renderers should implement.
+
+    `render` renders a complete object into the stream.  A list of objects
+    may also be rendered a row at a time, by calling `start` with the stream
+    and options, then `write_row` with each object as it is produced, and
+    finally `finish`.
+
+    By default the rows are collected, and rendered as a list once finished.
+    Renderers that can write each row as it arrives override all three.
     """
 
-    def render(obj, stream, **opts):
+    def render(self, obj, stream, **opts):
         return str(obj)
 
+    def start(self, stream, **opts):
+        self.stream = stream
+        self.opts = opts
+        self.rows = []
+
+    def write_row(self, row):
+        self.rows.append(row)
+
+    def finish(self):
+        self.render(self.rows, self.stream, **self.opts)
+
+    def render_rows(self, rows, stream, **opts):
+        """
+        Render a list of objects a row at a time.
+        """
+        self.start(stream, **opts)
+        for row in rows:
+            self.write_row(row)
+        self.finish()
+
+    def get_paths(self, item, columns=None):
+        """
+        Return the path of keys to each column's value, for renderers that
+        lay out a list of objects as rows of columns.
+
+        Nested objects are laid out from the fields they were converted
+        with, so that a missing nested object, such as a null foreign key,
+        still gets a column for each of its fields.
+        """
+        if columns is not None:
+            return [(column,) if column in item else tuple(column.split('.'))
+                    for column in columns]
+        fields = getattr(item, 'fields', None) or {}
+        paths = []
+        for key, value in item.items():
+            if is_mapping(value) and value:
+                nested = self.get_paths(value)
+            elif value is None and hasattr(fields.get(key), 'get_empty_paths'):
+                nested = fields[key].get_empty_paths()
+            else:
+                nested = []
+            paths.extend([(key,) + path for path in nested] or [(key,)])
+        return paths
+
 
 class JSONRenderer(BaseRenderer):
     """
     Render a native python object into JSON.
+
+    Lists and generators are encoded an item at a time, as they are
+    produced, and each chunk is written to the stream as soon as it is
+    encoded, so that large outputs use constant memory.
+
+    The encoding is done by a JSON backend, which may be set with the
+    `json_backend` option.
     """
+
     def render(self, obj, stream, **opts):
-        indent = opts.pop('indent', None)
-        sort_keys = opts.pop('sort_keys', False)
-        return json.dump(obj, stream, cls=DjangoJSONEncoder,
-                         indent=indent, sort_keys=sort_keys)
+        if _is_list(obj):
+            self.render_rows(obj, stream, **opts)
+            return
+        self.start(stream, **opts)
+        for chunk in self.backend.iterencode(obj, self.indent, self.sort_keys):
+            stream.write(chunk)
+
+    def start(self, stream, **opts):
+        self.stream = stream
+        self.indent = opts.pop('indent', None)
+        self.sort_keys = opts.pop('sort_keys', False)
+        self.backend = get_json_backend(opts.pop('json_backend', None))
+        self.separators = self.backend.list_separators(self.indent)
+        self.count = 0
+
+    def write_row(self, row):
+        write = self.stream.write
+        write(self.separators[1] if self.count else self.separators[0])
+        self.count += 1
+        for chunk in self.backend.iterencode_item(row, self.indent, self.sort_keys, level=1):
+            write(chunk)
+
+    def finish(self):
+        self.stream.write(self.separators[2] if self.count else '[]')
 
 
 class YAMLRenderer(BaseRenderer):
     """
     Render a native python object into YAML.
+
+    If the `libyaml` option is set, and LibYAML is installed, the output is
+    emitted by LibYAML.  This is much faster, but the output isn't always
+    formatted identically, eg. line wrapping and tags on timestamps may
+    differ, so it is off by default.
+
+    Lists of objects are rendered a row at a time, with each object dumped
+    as it arrives, as a one item block style list, so that large querysets
+    are rendered in constant memory.  Objects shared between rows are
+    repeated rather than aliased.  Rows that aren't objects, and lists
+    rendered with `default_flow_style=True`, are collected and dumped at
+    the end.
     """
+    libyaml = False
+
     def render(self, obj, stream, **opts):
+        if _is_list(obj):
+            self.render_rows(obj, stream, **opts)
+            return
+        self.dump(obj, stream, **opts)
+
+    def dump(self, obj, stream, **opts):
         indent = opts.pop('indent', None)
         default_flow_style = opts.pop('default_flow_style', None)
-        return yaml.dump(obj, stream, Dumper=SafeDumper,
+        libyaml = opts.pop('libyaml', self.libyaml)
+        dumper = (libyaml and CSafeDumper) or SafeDumper
+        return yaml.dump(obj, stream, Dumper=dumper,
                          indent=indent, default_flow_style=default_flow_style)
 
+    def start(self, stream, **opts):
+        super(YAMLRenderer, self).start(stream, **opts)
+        self.streaming = None
+
+    def write_row(self, row):
+        if self.streaming is None:
+            # One item flow style lists can't be joined into a single list.
+            self.streaming = (is_mapping(row) and
+                              self.opts.get('default_flow_style') is not True)
+        if self.streaming:
+            self.dump([row], self.stream, **dict(self.opts))
+        else:
+            self.rows.append(row)
+
+    def finish(self):
+        if not self.streaming:
+            self.dump(self.rows, self.stream, **self.opts)
+
+
+# Values that urlize might turn into links.
+_URL_HINT = re.compile(r'https?://|www\.|@|\.(com|net|org)\b')
+
 
 class HTMLRenderer(BaseRenderer):
     """
     A basic html renderer, that renders data into tabular format.
+
+    A list of objects is rendered as a single table, with a header row taken
+    from the fields of the first object, and each row written as it is
+    produced.  Nested objects are flattened into columns with dotted names,
+    as with `CSVRenderer`.  The `limit` and `page` options render a single
+    page of rows.
+
+    Values are only urlized in the columns listed by the `url_columns`
+    option, or if that isn't given, in columns whose first value looks like
+    it contains a url or email address.
     """
     def render(self, obj, stream, **opts):
-        self._to_html(stream, obj)
+        if not _is_list(obj):
+            self._to_html(stream, obj)
+            return
+        # Slice the rows here, so that rows after the page aren't produced.
+        limit = opts.pop('limit', None)
+        page = opts.pop('page', 1)
+        if limit is not None:
+            start = (page - 1) * limit
+            obj = itertools.islice(obj, start, start + limit)
+        self.render_rows(obj, stream, **opts)
+
+    def start(self, stream, **opts):
+        self.stream = stream
+        self.limit = opts.pop('limit', None)
+        self.skip = (opts.pop('page', 1) - 1) * (self.limit or 0)
+        self.url_columns = opts.pop('url_columns', None)
+        self.columns = None
+        self.is_table = None
+
+    def write_row(self, row):
+        if self.skip:
+            self.skip -= 1
+            return
+        if self.limit is not None:
+            if not self.limit:
+                return
+            self.limit -= 1
+
+        if self.is_table is None:
+            self.is_table = is_mapping(row)
+            if self.is_table:
+                self.start_table(row)
+            else:
+                self.stream.write('<ul>\n')
+
+        if not self.is_table:
+            self.stream.write('<li>')
+            self._to_html(self.stream, row)
+            self.stream.write('</li>')
+            return
+
+        cells = []
+        urlized = self.urlized
+        for column, path in zip(self.columns, self.paths):
+            value = _get_path(row, path)
+            if hasattr(value, '__iter__'):
+                cell = StringIO()
+                self._to_html(cell, value)
+                cells.append(u'<td>%s</td>' % cell.getvalue())
+                continue
+            value = smart_unicode(value)
+            if urlized[column] is None and value:
+                urlized[column] = bool(_URL_HINT.search(value))
+            if urlized[column]:
+                value = urlize(value, autoescape=True)
+            else:
+                value = escape(value)
+            cells.append(u'<td>%s</td>' % value)
+        self.stream.write(u'<tr>%s</tr>\n' % u''.join(cells))
+
+    def start_table(self, row):
+        self.paths = self.get_paths(row)
+        self.columns = [u'.'.join(map(smart_unicode, path)) for path in self.paths]
+        if self.url_columns is None:
+            self.urlized = dict.fromkeys(self.columns)
+        else:
+            self.urlized = dict([(column, column in self.url_columns) for column in self.columns])
+        self.stream.write(u'<table>\n<thead><tr>%s</tr></thead>\n<tbody>\n' %
+                          u''.join([u'<th>%s</th>' % escape(column) for column in self.columns]))
+
+    def finish(self):
+        if self.is_table:
+            self.stream.write(u'</tbody>\n</table>\n')
+        elif self.is_table is None:
+            self.stream.write('<ul>\n</ul>\n')
+        else:
+            self.stream.write('</ul>\n')
 
     def _to_html(self, stream, data):
-        if isinstance(data, dict):
+        if is_mapping(data):
             stream.write('<table>\n')
             for key, value in data.items():
                 stream.write('<tr><td>%s</td><td>' % key)
@@ -72,29 +303,54 @@ class HTMLRenderer(BaseRenderer):
 class XMLRenderer(BaseRenderer):
     """
     Render a native python object into a generic XML format.
+
+    The output is written to the stream as it is produced.
     """
+
     def render(self, obj, stream, **opts):
-        xml = SimplerXMLGenerator(stream, 'utf-8')
+        if _is_list(obj):
+            self.render_rows(obj, stream, **opts)
+            return
+        xml = XMLWriter(stream)
         xml.startDocument()
         self._to_xml(xml, obj)
         xml.endDocument()
 
+    def start(self, stream, **opts):
+        self.xml = XMLWriter(stream)
+        self.xml.startDocument()
+        self.xml.write('<list>')
+
+    def write_row(self, row):
+        self.xml.write('<item>')
+        self._to_xml(self.xml, row)
+        self.xml.write('</item>')
+
+    def finish(self):
+        self.xml.write('</list>')
+        self.xml.endDocument()
+
     def _to_xml(self, xml, data):
-        if isinstance(data, dict):
-            xml.startElement('object', {})
+        if is_mapping(data):
+            xml.write('<object>')
             for key, value in data.items():
-                xml.startElement(key, {})
+                xml.startElement(key)
                 self._to_xml(xml, value)
                 xml.endElement(key)
-            xml.endElement('object')
+            xml.write('</object>')
 
         elif hasattr(data, '__iter__'):
-            xml.startElement('list', {})
+            xml.write('<list>')
             for item in data:
-                xml.startElement('item', {})
+                xml.write('<item>')
                 self._to_xml(xml, item)
-                xml.endElement('item')
-            xml.endElement('list')
+                xml.write('</item>')
+            xml.write('</list>')
+
+        elif isinstance(data, Base64Payload):
+            # Base64 never needs escaping.
+            for chunk in data.chunks():
+                xml.write(chunk)
 
         else:
             xml.characters(smart_unicode(data))
@@ -103,17 +359,55 @@ class XMLRenderer(BaseRenderer):
 class DumpDataXMLRenderer(BaseRenderer):
     """
     Render a native python object into XML dumpdata format.
+
+    The order and `<field>` attributes of each model's fields are computed
+    once per document, and reused for every object of that model.
     """
+
     def render(self, obj, stream, **opts):
-        xml = SimplerXMLGenerator(stream, 'utf-8')
-        xml.startDocument()
-        xml.startElement('django-objects', {'version': '1.0'})
-        if hasattr(obj, '__iter__'):
-            [self.model_to_xml(xml, item) for item in obj]
-        else:
-            self.model_to_xml(xml, obj)
-        xml.endElement('django-objects')
-        xml.endDocument()
+        if not _is_list(obj):
+            obj = [obj]
+        self.render_rows(obj, stream, **opts)
+
+    def start(self, stream, **opts):
+        self.layouts = {}
+        self.xml = XMLWriter(stream)
+        self.xml.startDocument()
+        self.xml.startElement('django-objects', {'version': '1.0'})
+
+    def write_row(self, row):
+        self.model_to_xml(self.xml, row)
+
+    def finish(self):
+        self.xml.endElement('django-objects')
+        self.xml.endDocument()
+
+    def get_layout(self, xml, model, fields_data):
+        """
+        Return a list of `(key, serializer_field, attrs, start_tag)` tuples
+        for the fields of an object, in the order that they are rendered.
+        """
+        cache_key = (model, tuple(fields_data.keys()))
+        try:
+            return self.layouts[cache_key]
+        except KeyError:
+            pass
+
+        # Due to implmentation details, the existing xml dumpdata format
+        # renders ordered fields, whilst json and yaml render unordered
+        # fields (ordering determined by python's `dict` implementation)
+        # To maintain byte-for-byte backwards compatability,
+        # we'll deal with that now.
+        key_field = sorted([(key, fields_data.fields[key]) for key in fields_data],
+                           key=lambda x: x[1].creation_counter)
+
+        layout = []
+        for key, serializer_field in key_field:
+            attrs = {'name': key}
+            attrs.update(serializer_field.attributes())
+            layout.append((key, serializer_field, attrs, xml.start_tag('field', attrs)))
+        self.layouts[cache_key] = layout
+        return layout
 
     def model_to_xml(self, xml, data):
         pk = data['pk']
@@ -127,24 +421,9 @@ class DumpDataXMLRenderer(BaseRenderer):
 
         xml.startElement('object', attrs)
 
-        # For each item in fields get it's key, value and serializer field
-        key_val_field = [
-            (key, val, fields_data.fields[key])
-            for key, val in fields_data.items()
-        ]
-
-        # Due to implmentation details, the existing xml dumpdata format
-        # renders ordered fields, whilst json and yaml render unordered
-        # fields (ordering determined by python's `dict` implementation)
-        # To maintain byte-for-byte backwards compatability,
-        # we'll deal with that now.
-        key_val_field = sorted(key_val_field,
-                               key=lambda x: x[2].creation_counter)
-
-        for key, value, serializer_field in key_val_field:
-            attrs = {'name': key}
-            attrs.update(serializer_field.attributes())
-            xml.startElement('field', attrs)
+        for key, serializer_field, attrs, start_tag in self.get_layout(xml, model, fields_data):
+            value = fields_data[key]
+            xml.write(start_tag)
 
             if value is not None and getattr(serializer_field, 'is_natural_key', False):
                 self.handle_natural_key(xml, value)
@@ -154,6 +433,8 @@ class DumpDataXMLRenderer(BaseRenderer):
                 self.handle_datetimes(xml, value)
             elif value is None:
                 self.handle_none(xml)
+            elif isinstance(value, dict):
+                self.handle_dict(xml, value)
             else:
                 self.handle_value(xml, value)
 
@@ -171,23 +452,101 @@ class DumpDataXMLRenderer(BaseRenderer):
     def handle_datetimes(self, xml, value):
         xml.characters(value.isoformat())
 
+    def handle_dict(self, xml, value):
+        for key, item in value.items():
+            xml.startElement(key, {})
+            self.handle_value(xml, item)
+            xml.endElement(key)
+
     def handle_value(self, xml, value):
-        xml.characters(smart_unicode(value))
+        if isinstance(value, Base64Payload):
+            for chunk in value.chunks():
+                xml.write(chunk)
+        else:
+            xml.characters(smart_unicode(value))
 
     def handle_none(self, xml):
         xml.addQuickElement('None')
 
 
+def _format_csv_value(value):
+    if type(value) is unicode:
+        return value.encode('utf-8')
+    elif isinstance(value, (int, float)) or type(value) is str:
+        return value  # numbers are written by the csv module itself.
+    return str(value)
+
+
+# Formatters for common column types.  None means the value is written as is.
+_CSV_FORMATTERS = {
+    unicode: lambda value: value.encode('utf-8'),
+    str: None,
+    int: None,
+    long: None,
+    float: None,
+    bool: None,
+    types.NoneType: lambda value: 'None',
+}
+
+
 class CSVRenderer(BaseRenderer):
+    """
+    Render a list of objects into CSV, with a column for each key.
+
+    Nested objects are flattened into columns with dotted names, such as
+    `author.name`.  The columns are taken from the fields of the first
+    object, and the `columns` option may be used to render a subset of
+    them instead.
+
+    A formatter is chosen for each column from the type of its first value,
+    and each row is written as soon as it arrives.
+    """
+
     def render(self, obj, stream, **opts):
-        if isinstance(obj, dict) or not hasattr(obj, '__iter__'):
+        if not _is_list(obj):
             obj = [obj]
-        writer = None
-        for item in obj:
-            if not writer:
-                writer = DictWriter(stream, item.keys())
-                writer.writeheader()
-            writer.writerow(item)
+        self.render_rows(obj, stream, **opts)
+
+    def start(self, stream, **opts):
+        self.columns = opts.pop('columns', None)
+        self.writer = csv.writer(stream)
+        self.paths = None
+
+    def write_row(self, row):
+        if self.paths is None:
+            self.paths = self.get_paths(row, self.columns)
+            self.formatters = [None] * len(self.paths)
+            header = [path[0] if len(path) == 1 else u'.'.join(map(smart_unicode, path))
+                      for path in self.paths]
+            self.writer.writerow([_format_csv_value(name) for name in header])
+        self.writer.writerow(self.get_row(row, self.paths, self.formatters))
+
+    def finish(self):
+        pass
+
+    def get_row(self, item, paths, formatters):
+        row = []
+        append = row.append
+        index = 0
+        for path in paths:
+            if len(path) == 1:
+                value = item[path[0]] if path[0] in item else ''
+            else:
+                value = _get_path(item, path)
+
+            formatter = formatters[index]
+            if formatter is None:
+                value_type = type(value)
+                formatter = formatters[index] = (value_type, _CSV_FORMATTERS.get(value_type, _format_csv_value))
+            index += 1
+            if type(value) is formatter[0]:
+                if formatter[1] is not None:
+                    value = formatter[1](value)
+            else:
+                value = _format_csv_value(value)
+            append(value)
+        return row
+
 
 if not yaml:
     YAMLRenderer = None
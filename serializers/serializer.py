@@ -1,8 +1,18 @@
 from decimal import Decimal
-from django.core.serializers.base import DeserializedObject
+from django.core.serializers.base import DeserializedObject, DeserializationError
+from django.db import models
+from django.db.models.fields.related import ManyToOneRel
+from django.db.models.query import ValuesQuerySet
+from django.db.models.query_utils import DeferredAttribute
 from django.utils.datastructures import SortedDict
+from django.utils.encoding import smart_unicode
 import copy
 import datetime
+import itertools
+import operator
+import Queue
+import sys
+import threading
 import types
 from serializers.renderers import (
     JSONRenderer,
@@ -13,11 +23,29 @@ from serializers.renderers import (
 )
 from serializers.parsers import (
     JSONParser,
+    YAMLParser,
+    CSVParser,
 )
 from serializers.fields import *
-from serializers.utils import SortedDictWithMetadata, is_simple_callable
+from serializers.utils import (
+    SortedDictWithMetadata,
+    LazyDictWithMetadata,
+    Budget,
+    BufferedWriter,
+    CountingStream,
+    IdentityMap,
+    REFERENCE_KEY,
+    decode_continuation,
+    encode_continuation,
+    freeze,
+    is_mapping,
+    is_simple_callable,
+    materialise,
+    resolve_references,
+)
 from StringIO import StringIO
 from io import BytesIO
+from multiprocessing.pool import ThreadPool
 
 
 class RecursionOccured(BaseException):
@@ -38,6 +66,42 @@ def _is_protected_type(obj):
     )
 
 
+def _is_pk_relation(model_field):
+    """
+    True if the model field is a forward relationship that references the
+    primary key of the related model.
+    """
+    rel = getattr(model_field, 'rel', None)
+    return (isinstance(rel, ManyToOneRel) and
+            rel.field_name == rel.to._meta.pk.name)
+
+
+def _is_named_tuple(obj):
+    return isinstance(obj, tuple) and hasattr(obj, '_fields')
+
+
+def _record_keys(obj):
+    """
+    Return the keys of a mapping or named tuple record.
+    """
+    if isinstance(obj, tuple):
+        return obj._fields
+    return obj.keys()
+
+
+def _compile_accessor(obj, source):
+    """
+    Return a function that reads `source` from records shaped like `obj`.
+    """
+    if source == '*':
+        return lambda record: record
+    elif isinstance(obj, tuple) and source in obj._fields:
+        return operator.itemgetter(obj._fields.index(source))
+    elif isinstance(obj, tuple):
+        return operator.attrgetter(source)
+    return operator.itemgetter(source)
+
+
 def _get_declared_fields(bases, attrs):
     """
     Create a list of serializer field instances from the passed in 'attrs',
@@ -74,6 +138,14 @@ class SerializerOptions(object):
         self.nested = getattr(meta, 'nested', False)
         self.fields = getattr(meta, 'fields', ())
         self.exclude = getattr(meta, 'exclude', ())
+        self.references = getattr(meta, 'references', False)
+        self.chunk_size = getattr(meta, 'chunk_size', 100)
+        self.lazy = getattr(meta, 'lazy', False)
+        self.records = getattr(meta, 'records', False)
+        self.io_workers = getattr(meta, 'io_workers', 8)
+        self.identity_map_size = getattr(meta, 'identity_map_size', 1000)
+        self.json_backend = getattr(meta, 'json_backend', None)
+        self.write_size = getattr(meta, 'write_size', 2 ** 16)
         self.renderer_classes = getattr(meta, 'renderer_classes', {
             'xml': XMLRenderer,
             'json': JSONRenderer,
@@ -82,7 +154,9 @@ class SerializerOptions(object):
             'html': HTMLRenderer,
         })
         self.parser_classes = getattr(meta, 'parser_classes', {
-            'json': JSONParser
+            'json': JSONParser,
+            'yaml': YAMLParser,
+            'csv': CSVParser,
         })
 
 
@@ -99,6 +173,9 @@ class BaseSerializer(Field):
         self.opts = self._options_class(self.Meta)
         self.parent = None
         self.root = None
+        self.records = self.opts.records
+        self.io_pool = None
+        self._record_plans = {}
 
     #####
     # Methods to determine which fields to use when (de)serializing objects.
@@ -160,8 +237,11 @@ class BaseSerializer(Field):
         Same behaviour as usual Field, except that we need to keep track
         of state so that we can deal with handling maximum depth and recursion.
         """
+        context = getattr(self, 'context', None)
         super(BaseSerializer, self).initialize(parent, model_field)
         self.stack = parent.stack[:]
+        if self.context is not context:
+            self._record_plans = {}
         if parent.opts.nested and not isinstance(parent.opts.nested, bool):
             self.opts.nested = parent.opts.nested - 1
         else:
@@ -181,18 +261,124 @@ class BaseSerializer(Field):
         Core of serialization.
         Convert an object into a dictionary of serialized field values.
         """
+        identity_map = getattr(self.root or self, 'identity_map', None)
+        if identity_map is not None:
+            identity_map.visit(obj)
+
         if obj in self.stack and not self.source == '*':
             raise RecursionOccured()
         self.stack.append(obj)
 
+        if self.opts.lazy and self.root is None:
+            return self.convert_object_lazily(obj)
+
         ret = self._dict_class()
         ret.fields = {}
 
         fields = self.get_fields(serialize=True, obj=obj, nested=self.opts.nested)
         for field_name, field in fields.items():
             key = self.get_field_key(field_name)
+            ret[key] = self.convert_field(obj, field_name, field)
+            ret.fields[key] = field
+        return ret
+
+    def convert_field(self, obj, field_name, field):
+        """
+        Return the serialized value of a single field of an object.
+        """
+        try:
+            return field.field_to_native(obj, field_name)
+        except RecursionOccured:
+            field = self.get_fields(serialize=True, obj=obj, nested=False)[field_name]
+            return field.field_to_native(obj, field_name)
+
+    def convert_object_lazily(self, obj):
+        """
+        Like `convert_object`, but each field value is only computed when it
+        is first accessed.  Fields are shared between objects, so the state
+        they were set up with for this object is restored before converting.
+        """
+        ret = LazyDictWithMetadata()
+        ret.fields = {}
+
+        stack = self.stack[:]
+        fields = self.get_fields(serialize=True, obj=obj, nested=self.opts.nested)
+        for field_name, field in fields.items():
+            key = self.get_field_key(field_name)
+            model_field = getattr(field, 'model_field', None)
+
+            def compute(field_name=field_name, field=field, model_field=model_field):
+                current, self.stack = self.stack, stack
+                try:
+                    field.initialize(parent=self, model_field=model_field)
+                    return self.convert_field(obj, field_name, field)
+                finally:
+                    self.stack = current
+
+            ret.set_lazy(key, compute)
+            ret.fields[key] = field
+        return ret
+
+    def is_record(self, obj):
+        """
+        True if `obj` is a mapping or named tuple that should be serialized
+        as a single object, rather than treated as a container.
+
+        Named tuples are always records.  Dicts are only records once the
+        serializer has been given the rows of a `values()` queryset, or if
+        the `records` option is set.
+        """
+        if isinstance(obj, tuple):
+            return hasattr(obj, '_fields')
+        return isinstance(obj, dict) and self.records
+
+    def get_record_plan(self, obj):
+        """
+        Return a list of `(key, field_name, field, accessor)` tuples, used to
+        serialize records that are shaped like `obj`.  The plan is compiled
+        once per record shape, and reused for every record with that shape.
+        """
+        if isinstance(obj, tuple):
+            shape = obj.__class__
+        else:
+            shape = (obj.__class__, tuple(obj))
+        try:
+            return self._record_plans[shape]
+        except KeyError:
+            pass
+
+        plan = []
+        fields = self.get_fields(serialize=True, obj=obj, nested=self.opts.nested)
+        for field_name, field in fields.items():
+            if type(field).field_to_native.im_func in _ATTRIBUTE_READERS:
+                accessor = _compile_accessor(obj, field.source or field_name)
+            else:
+                accessor = None
+            plan.append((self.get_field_key(field_name), field_name, field, accessor))
+        self._record_plans[shape] = plan
+        return plan
+
+    def convert_record(self, obj):
+        """
+        Convert a mapping or named tuple into a dictionary of serialized
+        field values.
+
+        Records are plain data, so unlike `convert_object` there is no need
+        to guard against recursion, and the field plan may be cached.
+        """
+        ret = self._dict_class()
+        ret.fields = {}
+
+        for key, field_name, field, accessor in self.get_record_plan(obj):
             try:
-                value = field.field_to_native(obj, field_name)
+                if isinstance(field, BaseSerializer):
+                    field.initialize(parent=self, model_field=getattr(field, 'model_field', None))
+                if accessor is None:
+                    value = field.field_to_native(obj, field_name)
+                else:
+                    # Record values are raw values, not model attributes.
+                    field.obj = None
+                    value = field.to_native(accessor(obj))
             except RecursionOccured:
                 field = self.get_fields(serialize=True, obj=obj, nested=False)[field_name]
                 value = field.field_to_native(obj, field_name)
@@ -200,6 +386,106 @@ class BaseSerializer(Field):
             ret.fields[key] = field
         return ret
 
+    def is_objects(self, obj):
+        """
+        True if `obj` will be converted as a list of objects.
+        """
+        return (hasattr(obj, '__iter__') and not isinstance(obj, dict) and
+                not self.is_record(obj))
+
+    def is_object(self, obj):
+        """
+        True if `obj` will be converted into a dictionary of fields, rather
+        than being returned as-is, or treated as a container.
+        """
+        if self.is_record(obj):
+            return True
+        return not (_is_protected_type(obj) or is_simple_callable(obj) or
+                    isinstance(obj, dict) or hasattr(obj, '__iter__'))
+
+    def convert_objects(self, objects, budget=None):
+        """
+        Convert an iterable of objects, a chunk at a time, so that any
+        per-object work can be batched up by `prepare_objects`.
+
+        If a budget is given, stop cleanly once it has been used up.  With a
+        `max_objects` limit, only the objects that fit, and one more to tell
+        whether there are any more, are fetched and prepared.
+        """
+        if isinstance(objects, ValuesQuerySet):
+            self.records = True
+        if budget is not None and budget.max_objects is not None:
+            limit = budget.max_objects - budget.objects + 1
+            if isinstance(objects, models.query.QuerySet):
+                objects = objects[:limit]
+            else:
+                objects = itertools.islice(objects, limit)
+        if (isinstance(objects, models.query.QuerySet) and objects._result_cache is None and
+            not objects._prefetch_related_lookups):
+            # Stream the rows, rather than filling the queryset's result cache.
+            iterator = objects.iterator()
+        else:
+            iterator = iter(objects)
+        depth = len(self.stack)
+        while True:
+            size = self.opts.chunk_size
+            if budget is not None and budget.max_objects is not None:
+                size = max(1, min(size, budget.max_objects - budget.objects))
+            chunk = list(itertools.islice(iterator, size))
+            if not chunk or (budget is not None and not budget.allows()):
+                return
+            self.prepare_objects(chunk)
+            for item in chunk:
+                if budget is not None and not budget.allows():
+                    return
+                native = self.to_native(item)
+                # Siblings aren't ancestors, so drop them from the recursion
+                # stack, rather than holding on to every object converted.
+                del self.stack[depth:]
+                yield native
+                if budget is not None:
+                    budget.spend(item)
+
+    def resume_objects(self, objects, position):
+        """
+        Return the objects following `position`, as returned by
+        `get_position`, or all the objects if `position` is None.
+        """
+        if position is None:
+            return objects
+        if not isinstance(position.get('offset'), (int, long)):
+            raise ValueError('Invalid continuation position %r' % position)
+        if isinstance(objects, models.query.QuerySet):
+            return objects[position['offset']:]
+        return itertools.islice(objects, position['offset'], None)
+
+    def get_position(self, objects, position, count, last):
+        """
+        Return the position following `last`, which is the `count`th object
+        emitted after `position`.
+        """
+        offset = position['offset'] if position is not None else 0
+        return {'offset': offset + count}
+
+    def prepare_objects(self, objects):
+        """
+        Called with each chunk of objects before any of them are converted.
+        """
+        cls = objects[0].__class__
+        if not self.is_object(objects[0]):
+            return
+        objects = [obj for obj in objects if obj.__class__ is cls]
+        fields = self.get_fields(serialize=True, obj=objects[0], nested=self.opts.nested)
+        self.prefetch_fields(objects, fields)
+
+    def prefetch_fields(self, objects, fields):
+        """
+        Give each field the chance to batch up work for a chunk of objects,
+        rather than repeating it for every object.
+        """
+        for field_name, field in fields.items():
+            field.prefetch(objects, field_name)
+
     def restore_fields(self, data):
         """
         Core of deserialization, together with `restore_object`.
@@ -230,11 +516,14 @@ class BaseSerializer(Field):
             return obj
         elif is_simple_callable(obj):
             return self.to_native(obj())
-        elif isinstance(obj, dict):
-            return dict([(key, self.to_native(val))
-                         for (key, val) in obj.items()])
+        elif self.is_record(obj):
+            return self.convert_record(obj)
+        elif is_mapping(obj):
+            to_native = self.to_native
+            return dict([(key, val if _is_protected_type(val) else to_native(val))
+                         for (key, val) in obj.iteritems()])
         elif hasattr(obj, '__iter__'):
-            return (self.to_native(item) for item in obj)
+            return self.convert_objects(obj)
         return self.convert_object(obj)
 
     def from_native(self, data):
@@ -243,17 +532,26 @@ class BaseSerializer(Field):
         """
         if _is_protected_type(data):
             return data
-        elif hasattr(data, '__iter__') and not isinstance(data, dict):
+        elif hasattr(data, '__iter__') and not is_mapping(data):
             return (self.from_native(item) for item in data)
         else:
             attrs = self.restore_fields(data)
             return self.restore_object(attrs, instance=getattr(self, 'instance', None))
 
+    def get_renderer(self, format, options):
+        """
+        Return a renderer for the format, adding any options from `Meta`.
+        """
+        renderer = self.opts.renderer_classes[format]()
+        if isinstance(renderer, JSONRenderer) and self.opts.json_backend is not None:
+            options.setdefault('json_backend', self.opts.json_backend)
+        return renderer
+
     def render(self, data, stream, format, **options):
         """
         Render primatives -> bytestream for serialization.
         """
-        renderer = self.opts.renderer_classes[format]()
+        renderer = self.get_renderer(format, options)
         return renderer.render(data, stream, **options)
 
     def parse(self, stream, format, **options):
@@ -261,6 +559,8 @@ class BaseSerializer(Field):
         Parse bytestream -> primatives for deserialization.
         """
         parser = self.opts.parser_classes[format]()
+        if isinstance(parser, JSONParser) and self.opts.json_backend is not None:
+            options.setdefault('json_backend', self.opts.json_backend)
         return parser.parse(stream, **options)
 
     def serialize(self, format, obj, context=None, **options):
@@ -269,21 +569,210 @@ class BaseSerializer(Field):
         First converts the objects into primatives,
         then renders primative types to bytestream.
         """
-        self.stack = []
-        self.context = context or {}
+        self.start_serialization(context, options.pop('using', None),
+                                 options.pop('records', self.opts.records))
 
-        data = self.to_native(obj)
-        if format != 'python':
-            stream = options.pop('stream', StringIO())
-            self.render(data, stream, format, **options)
+        limits = dict([(key, options.pop(key)) for key in
+                       ('max_time', 'max_objects', 'max_bytes') if key in options])
+        budget = Budget(**limits) if limits else None
+        token = options.pop('continuation', None)
+        position = decode_continuation(token) if token is not None else None
+
+        if isinstance(obj, models.query.QuerySet) and self.using is not None:
+            obj = obj.using(self.using)
+
+        if (budget is not None or position is not None) and self.is_objects(obj):
+            if isinstance(obj, ValuesQuerySet):
+                self.records = True
+            obj = self.resume_objects(obj, position)
+            data = self.convert_objects(obj, budget or Budget())
+        else:
+            budget = None
+            data = self.to_native(obj)
+
+        data = self.add_references(data)
+        if format == 'python' and budget is None and isinstance(data, types.GeneratorType):
+            # The objects are converted as the caller consumes them.
+            self.value = self.finish_when_consumed(data)
+        elif format != 'python':
+            try:
+                stream = options.pop('stream', StringIO())
+                output = BufferedWriter(stream, options.pop('write_size', self.opts.write_size))
+                if budget is not None and budget.max_bytes is not None:
+                    self.render(data, CountingStream(output, budget), format, **options)
+                else:
+                    self.render(data, output, format, **options)
+                output.flush()
+            finally:
+                self.finish_serialization()
             if hasattr(stream, 'getvalue'):
                 self.value = stream.getvalue()
             else:
                 self.value = None
         else:
+            try:
+                if budget is not None:
+                    data = materialise(data)
+            finally:
+                self.finish_serialization()
             self.value = data
+
+        if budget is not None and budget.exhausted:
+            position = self.get_position(obj, position, budget.objects, budget.last)
+            self.continuation = encode_continuation(position)
         return self.value
 
+    def start_serialization(self, context, using=None, records=False):
+        """
+        Reset the per-serialization state of the root serializer.
+        """
+        self.stack = []
+        self.context = context or {}
+        self.using = using
+        self.records = records
+        self.identity_map = IdentityMap(self.opts.identity_map_size)
+        self._record_plans = {}
+        self.references = SortedDict() if self.opts.references else None
+        self.continuation = None
+        self.finish_serialization()
+
+    def finish_serialization(self):
+        """
+        Release the resources held for a serialization, once it's finished.
+        """
+        if self.io_pool is not None:
+            self.io_pool.close()
+            self.io_pool.join()
+            self.io_pool = None
+
+    def finish_when_consumed(self, rows):
+        """
+        Yield the rows, finishing the serialization once they're consumed.
+        """
+        try:
+            for row in rows:
+                yield row
+        finally:
+            self.finish_serialization()
+
+    def get_io_pool(self):
+        """
+        Return the pool of threads that I/O bound fields are fetched on.
+        It's started on first use, and shared by every chunk and field until
+        the serialization is finished.
+        """
+        if self.io_pool is None:
+            self.io_pool = ThreadPool(self.opts.io_workers)
+        return self.io_pool
+
+    def add_references(self, data):
+        """
+        If the `references` option is set, wrap the serialized data together
+        with the side table of the objects it references.
+        """
+        if self.references is None:
+            return data
+        return SortedDict((
+            ('data', materialise(data)),
+            ('objects', self.references)
+        ))
+
+    def serialize_many(self, targets, obj, context=None, threads=False, **options):
+        """
+        Serialize objects once, and render them to several targets.
+
+        Each target is a `(format, stream)` or `(format, stream, options)`
+        tuple.  The objects are converted a single time, and each renderer
+        receives the same read-only rows, with any nested generators already
+        evaluated.
+
+        By default each row is pushed to every target's renderer in turn, as
+        it is produced.  With `threads=True` each target is rendered on its
+        own thread, fed through a bounded queue.
+
+        Returns the rendered value of each target, as `serialize` would.
+        """
+        self.start_serialization(context, options.pop('using', None),
+                                 options.pop('records', self.opts.records))
+        if isinstance(obj, models.query.QuerySet) and self.using is not None:
+            obj = obj.using(self.using)
+        data = self.add_references(self.to_native(obj))
+        targets = [(target[0], target[1], dict(options, **(target[2] if len(target) > 2 else {})))
+                   for target in targets]
+        targets = [(format, BufferedWriter(stream, opts.pop('write_size', self.opts.write_size)), opts)
+                   for format, stream, opts in targets]
+
+        try:
+            if not isinstance(data, types.GeneratorType):
+                data = freeze(data)
+                for format, stream, opts in targets:
+                    self.render(data, stream, format, **opts)
+                    stream.flush()
+            elif not threads:
+                renderers = [self.get_renderer(format, opts) for format, stream, opts in targets]
+                for renderer, (format, stream, opts) in zip(renderers, targets):
+                    renderer.start(stream, **opts)
+                for row in data:
+                    row = freeze(row)
+                    for renderer in renderers:
+                        renderer.write_row(row)
+                for renderer, (format, stream, opts) in zip(renderers, targets):
+                    renderer.finish()
+                    stream.flush()
+            else:
+                self.render_threaded(data, targets)
+        finally:
+            self.finish_serialization()
+
+        return [stream.getvalue() if hasattr(stream, 'getvalue') else None
+                for format, stream, opts in targets]
+
+    def render_threaded(self, rows, targets, queue_size=100):
+        """
+        Render rows to each of the targets on a separate thread.  Rows are
+        evaluated on the calling thread, so renderers never touch the database.
+        Each renderer is given the rows a row at a time, as when rendering
+        sequentially, so renderers that only implement `render` get a list.
+        """
+        end = object()
+        errors = []
+
+        def render(queue, renderer, stream, opts):
+            def items():
+                item = queue.get()
+                while item is not end:
+                    yield item
+                    item = queue.get()
+            items = items()
+            try:
+                renderer.render_rows(items, stream, **opts)
+                stream.flush()
+            except Exception:
+                errors.append(sys.exc_info())
+            # Keep draining the queue so that the other targets aren't blocked.
+            for item in items:
+                pass
+
+        queues = [Queue.Queue(queue_size) for target in targets]
+        workers = [threading.Thread(target=render,
+                                    args=(queue, self.get_renderer(format, opts), stream, opts))
+                   for queue, (format, stream, opts) in zip(queues, targets)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            for row in rows:
+                row = freeze(row)
+                for queue in queues:
+                    queue.put(row)
+        finally:
+            for queue in queues:
+                queue.put(end)
+            for worker in workers:
+                worker.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
     def deserialize(self, format, stream_or_string, instance=None, context=None, **options):
         """
         Perform deserialization of bytestream into objects.
@@ -292,6 +781,9 @@ class BaseSerializer(Field):
         """
         self.stack = []
         self.context = context or {}
+        self.using = options.pop('using', None)
+        self.identity_map = None
+        self.references = None
         self.instance = instance
 
         if format != 'python':
@@ -302,6 +794,12 @@ class BaseSerializer(Field):
             data = self.parse(stream, format, **options)
         else:
             data = stream_or_string
+
+        if self.opts.references and isinstance(data, dict):
+            try:
+                data = resolve_references(data['data'], data['objects'])
+            except KeyError as exc:
+                raise DeserializationError('Unresolved reference %s' % exc)
         return self.from_native(data)
 
 
@@ -327,8 +825,13 @@ class ModelSerializer(RelatedField, Serializer):
     def default_fields(self, serialize, obj=None, data=None, nested=False):
         """
         Return all the fields that should be serialized for the model.
+
+        When serializing records, such as `values()` rows, only the model
+        fields present in the record are used, together with any other keys
+        in the record, such as annotations.
         """
-        if serialize:
+        record = serialize and not isinstance(obj, models.Model)
+        if serialize and not record:
             cls = obj.__class__
         else:
             cls = self.opts.model
@@ -341,18 +844,290 @@ class ModelSerializer(RelatedField, Serializer):
         fields += [field for field in opts.fields if field.serialize]
         fields += [field for field in opts.many_to_many if field.serialize]
 
+        if record:
+            keys = set(_record_keys(obj))
+
         ret = SortedDict()
         for model_field in fields:
-            if model_field.rel and nested:
+            source = None
+            if record:
+                if model_field.attname in keys and model_field.name not in keys:
+                    source = model_field.attname
+                elif model_field.name not in keys:
+                    continue
+                keys.discard(model_field.attname)
+                keys.discard(model_field.name)
+
+            if model_field.rel and nested and not record:
                 field = self.get_nested_field(model_field)
             elif model_field.rel:
                 field = self.get_related_field(model_field)
             else:
                 field = self.get_field(model_field)
             field.initialize(parent=self, model_field=model_field)
+            if source:
+                field.source = source
             ret[model_field.name] = field
+
+        if record:
+            for key in _record_keys(obj):
+                if key in keys:
+                    field = Field()
+                    field.initialize(parent=self)
+                    ret[key] = field
         return ret
 
+    def get_empty_paths(self, seen=()):
+        """
+        Return the path of keys to each value that this nested serializer
+        converts a related object into, for when the object is missing, eg.
+        a null foreign key.  Renderers that flatten nested objects into
+        columns use these to lay out the columns of the missing object.
+        """
+        model_field = getattr(self, 'model_field', None)
+        if not isinstance(model_field, models.ForeignKey) or model_field.rel.to in seen:
+            return []
+        model = model_field.rel.to
+        paths = []
+        fields = self.get_fields(serialize=True, obj=model(), nested=self.opts.nested)
+        for field_name, field in fields.items():
+            key = self.get_field_key(field_name)
+            nested = getattr(field, 'get_empty_paths', None)
+            nested = nested(seen + (model,)) if nested is not None else []
+            paths.extend([(key,) + path for path in nested] or [(key,)])
+        return paths
+
+    def prefetch_fields(self, objects, fields):
+        """
+        Batch up the model lookups that serializing the fields would
+        otherwise make for each object in turn.
+        """
+        if isinstance(objects[0], models.Model):
+            self.load_deferred_fields(objects, fields)
+            self.load_child_instances(objects, fields)
+        super(ModelSerializer, self).prefetch_fields(objects, fields)
+
+    def load_deferred_fields(self, objects, fields):
+        """
+        Load any deferred model fields that will be serialized with a single
+        query for the chunk, rather than one query per field per object.
+        Fields inherited from parent models are fetched in the same query,
+        joined across the inheritance chain.
+        """
+        cls = objects[0].__class__
+        deferred = []
+        for field in fields.values():
+            attname = getattr(getattr(field, 'model_field', None), 'attname', None)
+            if isinstance(cls.__dict__.get(attname), DeferredAttribute):
+                deferred.append(field.model_field)
+
+        objects = [obj for obj in objects
+                   if [f for f in deferred if f.attname not in obj.__dict__]]
+        if not objects:
+            return
+
+        manager = cls._meta.concrete_model._base_manager.using(self.get_db(objects[0]))
+        names = [model_field.name for model_field in deferred]
+        rows = manager.filter(pk__in=[obj.pk for obj in objects]).values_list('pk', *names)
+        values = dict([(row[0], row[1:]) for row in rows])
+        for obj in objects:
+            for model_field, value in zip(deferred, values.get(obj.pk, ())):
+                obj.__dict__.setdefault(model_field.attname, value)
+
+    def load_child_instances(self, objects, fields):
+        """
+        When serializing a parent model with fields that use the reverse
+        parent links to child models, fetch the child instances for the
+        whole chunk with one query per child model.
+        """
+        sources = set([field.source or field_name for field_name, field in fields.items()])
+        for related in objects[0]._meta.get_all_related_objects():
+            if not (related.field.rel.parent_link and
+                    related.get_accessor_name() in sources):
+                continue
+
+            cache_name = related.get_cache_name()
+            pending = [obj for obj in objects if not hasattr(obj, cache_name)]
+            if not pending:
+                continue
+
+            manager = related.model._base_manager.using(self.get_db(pending[0]))
+            children = manager.in_bulk([obj.pk for obj in pending])
+            for obj in pending:
+                child = children.get(obj.pk)
+                setattr(obj, cache_name, child)
+                if child is not None:
+                    setattr(child, related.field.get_cache_name(), obj)
+
+    def field_to_native(self, obj, field_name):
+        """
+        Nested model instances are memoised in the root serializer's identity
+        map, so that instances which are referenced many times over are only
+        fetched and converted once.
+        """
+        identity_map = getattr(self.root, 'identity_map', None)
+        if identity_map is None:
+            return super(ModelSerializer, self).field_to_native(obj, field_name)
+
+        model_field = getattr(self, 'model_field', None)
+        if _is_pk_relation(model_field):
+            pk = getattr(obj, model_field.attname)
+            if pk is not None:
+                fetch = lambda: self.get_related_object(obj, field_name)
+                return self.convert_related(model_field.rel.to, pk, fetch)
+
+        related = self.get_related_object(obj, field_name)
+        if related.__class__.__name__ in ('RelatedManager', 'ManyRelatedManager'):
+            return [self.convert_related(item.__class__, item.pk, lambda: item)
+                    for item in self.annotate_queryset(self.get_related_queryset(related))]
+        elif isinstance(related, models.Model) and related.pk is not None:
+            return self.convert_related(related.__class__, related.pk, lambda: related)
+        return self.to_native(related)
+
+    def convert_related(self, model, pk, fetch):
+        """
+        Return the native representation of a related instance, using the
+        identity map to avoid refetching or reconverting it where possible.
+        """
+        identity_map = self.root.identity_map
+        key = (self.get_identity_key(), model, pk)
+
+        cached = identity_map.lookup(key, self.stack)
+        if cached is not None:
+            instance, native = cached
+            self.stack.append(instance)
+            return self.get_reference(model, pk, native)
+
+        instance = identity_map.get_instance(model, pk)
+        if instance is None:
+            instance = fetch()
+            identity_map.add_instance(instance)
+        native = identity_map.convert(key, instance, self.to_native, self.stack)
+        return self.get_reference(model, pk, native)
+
+    def get_reference(self, model, pk, native):
+        """
+        If the root serializer is using the `references` option, store the
+        native representation in the side table and return a reference to it.
+        """
+        references = self.root.references
+        if references is None:
+            return native
+
+        key = u'%s:%s' % (smart_unicode(model._meta), smart_unicode(pk))
+        existing = references.setdefault(key, native)
+        if existing is not native and existing != native:
+            # A different representation of the same instance, such as one
+            # that fell back to a flat representation to avoid recursion.
+            return native
+        return {REFERENCE_KEY: key}
+
+    def convert_objects(self, objects, budget=None):
+        if isinstance(objects, models.query.QuerySet):
+            objects = self.annotate_queryset(objects)
+        return super(ModelSerializer, self).convert_objects(objects, budget)
+
+    def annotate_queryset(self, queryset):
+        """
+        Add the expressions of any aggregate fields that will be serialized
+        to the queryset, so that their values are fetched with it.
+        """
+        query = queryset.query
+        if isinstance(queryset, ValuesQuerySet):
+            # Annotating groups by the selected columns, which would merge
+            # rows unless the primary key is one of them.
+            pk = queryset.model._meta.pk
+            if not set(queryset.field_names) & set(['pk', pk.name, pk.attname]):
+                return queryset
+
+        annotations = {}
+        for field_name, field in self.fields.items():
+            if (not isinstance(field, AggregateField) or
+                (self.opts.fields and field_name not in self.opts.fields) or
+                field_name in self.opts.exclude):
+                continue
+            name = field.source or field_name
+            if name not in query.aggregates:
+                annotations[name] = field.expression
+        if annotations:
+            return queryset.annotate(**annotations)
+        return queryset
+
+    def get_keyset(self, objects):
+        """
+        Return a list of (model field, descending) pairs that uniquely orders
+        a queryset, or None if the objects can't be paged through by keyset.
+        """
+        if not isinstance(objects, models.query.QuerySet) or isinstance(objects, ValuesQuerySet):
+            return None
+        query = objects.query
+        if query.low_mark or query.high_mark is not None or query.extra_order_by:
+            return None
+
+        opts = objects.model._meta
+        ordering = query.order_by or (query.default_ordering and opts.ordering) or []
+        keyset = []
+        for name in ordering:
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            try:
+                field = opts.pk if name == 'pk' else opts.get_field(name)
+            except models.FieldDoesNotExist:
+                return None  # Eg. random or related field ordering.
+            if field is not opts.pk and (field.rel or field.null):
+                return None
+            keyset.append((field, descending))
+        if opts.pk not in [field for field, descending in keyset]:
+            keyset.append((opts.pk, False))
+        return keyset
+
+    def resume_objects(self, objects, position):
+        """
+        Querysets are paged through by the values of the fields they are
+        ordered by, so that pages stay consistent as rows are added or
+        removed, and later pages are as cheap to fetch as the first.
+        """
+        keyset = self.get_keyset(objects)
+        if keyset is None:
+            return super(ModelSerializer, self).resume_objects(objects, position)
+
+        pk = objects.model._meta.pk
+        names = ['pk' if field is pk else field.name for field, descending in keyset]
+        objects = objects.order_by(*[('-' if descending else '') + name
+                                     for name, (field, descending) in zip(names, keyset)])
+        if position is None:
+            return objects
+
+        after = position.get('after')
+        if not isinstance(after, list) or len(after) != len(keyset):
+            raise ValueError('Invalid continuation position %r' % position)
+        values = [field.to_python(value) for (field, descending), value in zip(keyset, after)]
+
+        # (a > x) | (a == x & b > y) | (a == x & b == y & c > z) ...
+        query = None
+        for index, ((field, descending), value) in enumerate(zip(keyset, values)):
+            lookup = '%s__%s' % (names[index], 'lt' if descending else 'gt')
+            clause = models.Q(**{lookup: value})
+            for name, previous in zip(names[:index], values[:index]):
+                clause &= models.Q(**{name: previous})
+            query = clause if query is None else query | clause
+        return objects.filter(query)
+
+    def get_position(self, objects, position, count, last):
+        keyset = self.get_keyset(objects)
+        if keyset is None:
+            return super(ModelSerializer, self).get_position(objects, position, count, last)
+        return {'after': [field.value_to_string(last) for field, descending in keyset]}
+
+    def get_identity_key(self):
+        """
+        Return a key identifying the representation this serializer produces,
+        so that cached representations are only shared between equivalent
+        serializers.
+        """
+        return (self.__class__, self.opts.nested,
+                tuple(self.opts.fields), tuple(self.opts.exclude))
+
     def get_nested_field(self, model_field):
         """
         Creates a default instance of a nested relational field.
@@ -380,3 +1155,13 @@ class ModelSerializer(RelatedField, Serializer):
             if field.name in attrs:
                 m2m_data[field.name] = attrs.pop(field.name)
         return DeserializedObject(self.opts.model(**attrs), m2m_data)
+
+
+# Fields whose value is simply the attribute named by their source.
+# These can be read from record sources using compiled accessors.
+_ATTRIBUTE_READERS = (
+    Field.field_to_native.im_func,
+    RelatedField.field_to_native.im_func,
+    PrimaryKeyRelatedField.field_to_native.im_func,
+    ModelSerializer.field_to_native.im_func,
+)
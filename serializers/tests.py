@@ -1,11 +1,38 @@
+import collections
 import datetime
+import tempfile
+import threading
+import time
+import weakref
+import yaml
+from StringIO import StringIO
 from decimal import Decimal
+from django.contrib.contenttypes import generic
+from django.contrib.contenttypes.models import ContentType
 from django.core import serializers
-from django.db import models
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.serializers.base import DeserializationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import connection, models
+from django.db.models import Count
 from django.test import TestCase
+from django.utils import simplejson as json
+from django.utils import unittest
 from django.utils.datastructures import SortedDict
 from serializers import Serializer, ModelSerializer, FixtureSerializer
 from serializers.fields import Field, NaturalKeyRelatedField, PrimaryKeyRelatedField
+from serializers.fields import GenericForeignKeyField, Base64FileField, BatchField
+from serializers.fields import AggregateField
+from serializers.backends import JSONBackend, LibraryJSONBackend, SimpleJSONBackend
+from serializers.parsers import CSVParser, DumpDataXMLParser, YAMLParser
+from serializers.renderers import BaseRenderer, CSVRenderer, DumpDataXMLRenderer, HTMLRenderer
+from serializers.utils import BufferedWriter, DjangoJSONEncoder, is_mapping
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
 
 # ObjectSerializer has been removed from serializers
 # leaving it in the tests for the moment for more coverage.
@@ -48,7 +75,7 @@ def expand(obj):
     """
     Unroll any generators in returned object.
     """
-    if isinstance(obj, dict):
+    if is_mapping(obj):
         ret = SortedDict()  # Retain original ordering
         for key, val in obj.items():
             ret[key] = expand(val)
@@ -173,6 +200,161 @@ class EncoderTests(SerializationTestCase):
         self.assertEquals(output, expected)
 
 
+class TestStreamingJSON(SerializationTestCase):
+    def test_streams_generators(self):
+        """
+        Items are written as they are produced, rather than once the whole
+        list has been evaluated.
+        """
+        produced = []
+        written = []
+
+        def items():
+            for index in range(3):
+                produced.append(index)
+                yield {'index': index, 'values': (value for value in range(index))}
+
+        class Stream(StringIO):
+            def write(self, data):
+                written.append((data, len(produced)))
+                StringIO.write(self, data)
+
+        class UnchunkedSerializer(ObjectSerializer):
+            class Meta:
+                chunk_size = 1
+
+        output = UnchunkedSerializer().serialize('json', items(), stream=Stream(), write_size=1)
+        self.assertEquals(output, '[{"index": 0, "values": []}, {"index": 1, "values": [0]}, '
+                                  '{"index": 2, "values": [0, 1]}]')
+        self.assertEquals(written[0], ('[', 1))
+        self.assertTrue(len(written) > 3)
+
+    def test_empty_generator(self):
+        output = ObjectSerializer().serialize('json', (item for item in []), indent=2)
+        self.assertEquals(output, '[]')
+
+
+class TestStreamingXML(SerializationTestCase):
+    def test_escaping(self):
+        obj = SortedDict([('a', u'caf\xe9 & <b>'), ('b', [1, None, {'c': 'x > y'}])])
+        expected = ('<?xml version="1.0" encoding="utf-8"?>\n<object>'
+                    '<a>caf\xc3\xa9 &amp; &lt;b&gt;</a>'
+                    '<b><list><item>1</item><item>None</item>'
+                    '<item><object><c>x &gt; y</c></object></item></list></b></object>')
+        self.assertEquals(ObjectSerializer().serialize('xml', obj), expected)
+
+    def test_streams_generators(self):
+        """
+        The output is written to the stream as the buffer fills, rather than
+        once the whole document has been rendered.
+        """
+        produced = []
+        written = []
+
+        def items():
+            for index in range(3):
+                produced.append(index)
+                yield {'index': index}
+
+        class Stream(StringIO):
+            def write(self, data):
+                written.append(len(produced))
+                StringIO.write(self, data)
+
+        class UnchunkedSerializer(ObjectSerializer):
+            class Meta:
+                chunk_size = 1
+
+        output = UnchunkedSerializer().serialize('xml', items(), stream=Stream(), write_size=1)
+        self.assertEquals(output, '<?xml version="1.0" encoding="utf-8"?>\n<list>'
+                                  '<item><object><index>0</index></object></item>'
+                                  '<item><object><index>1</index></object></item>'
+                                  '<item><object><index>2</index></object></item></list>')
+        self.assertEquals(written[0], 0)
+        self.assertTrue(written.index(3) > 3)
+
+
+class TestStreamingYAML(SerializationTestCase):
+    def test_streams_generators(self):
+        """
+        Each object is written to the stream as it is produced.
+        """
+        produced = []
+        written = []
+
+        def items():
+            for index in range(3):
+                produced.append(index)
+                yield {'index': index}
+
+        class Stream(StringIO):
+            def write(self, data):
+                written.append(len(produced))
+                StringIO.write(self, data)
+
+        class UnchunkedSerializer(ObjectSerializer):
+            class Meta:
+                chunk_size = 1
+
+        output = UnchunkedSerializer().serialize('yaml', items(), stream=Stream(), write_size=1)
+        self.assertEquals(output, '- {index: 0}\n- {index: 1}\n- {index: 2}\n')
+        self.assertEquals(output, ObjectSerializer().serialize('yaml', list(items())))
+        self.assertEquals(written[0], 1)
+        self.assertEquals(sorted(set(written)), [1, 2, 3])
+
+    def test_scalar_rows(self):
+        self.assertEquals(ObjectSerializer().serialize('yaml', [1, 'a']), '[1, a]\n')
+        self.assertEquals(ObjectSerializer().serialize('yaml', []), '[]\n')
+
+    def test_flow_style(self):
+        obj = [{'a': 1}, {'a': 2}]
+        output = ObjectSerializer().serialize('yaml', obj, default_flow_style=True)
+        self.assertEquals(output, '[{a: 1}, {a: 2}]\n')
+        self.assertEquals(yaml.safe_load(output), obj)
+        output = ObjectSerializer().serialize('yaml', obj, default_flow_style=False)
+        self.assertEquals(yaml.safe_load(output), obj)
+
+
+class TestBufferedWriter(SerializationTestCase):
+    def test_collects_writes(self):
+        class Stream(StringIO):
+            writes = []
+
+            def write(self, data):
+                self.writes.append(data)
+                StringIO.write(self, data)
+
+        stream = Stream()
+        writer = BufferedWriter(stream, write_size=16)
+        for data in ['<a>', u'caf\xe9', '</a>', '<b>', '</b>']:
+            writer.write(data)
+        self.assertEquals(stream.writes, ['<a>caf\xc3\xa9</a><b></b>'])
+        writer.write('0123456789')
+        self.assertEquals(len(stream.writes), 1)
+        writer.flush()
+        self.assertEquals(stream.writes[-1], '0123456789')
+        writer.write('0123456789' * 2)
+        self.assertEquals(stream.writes[-1], '0123456789' * 2)
+        self.assertEquals(writer.getvalue(), '<a>caf\xc3\xa9</a><b></b>' + '0123456789' * 3)
+
+    def test_write_size(self):
+        writes = []
+
+        class Stream(StringIO):
+            def write(self, data):
+                writes.append(data)
+                StringIO.write(self, data)
+
+        obj = [{'index': index} for index in range(100)]
+        output = ObjectSerializer().serialize('xml', obj, stream=Stream())
+        self.assertEquals(len(writes), 1)
+        del writes[:]
+        self.assertEquals(ObjectSerializer().serialize('xml', obj, stream=Stream(),
+                                                       write_size=256), output)
+        self.assertTrue(1 < len(writes) < 20)
+        self.assertTrue(isinstance(ObjectSerializer().serialize('html', obj), str))
+
+
 class BasicSerializerTests(SerializationTestCase):
     def setUp(self):
         self.obj = ExampleObject()
@@ -275,6 +457,145 @@ class SerializeAttributeTests(SerializationTestCase):
         self.assertEquals(CustomSerializer().serialize('python', self.obj), expected)
 
 
+class CountingPerson(Person):
+    """
+    A person that records which of its methods have been called.
+    """
+    def __init__(self, *args, **kwargs):
+        super(CountingPerson, self).__init__(*args, **kwargs)
+        self._calls = []
+
+    def is_child(self):
+        self._calls.append('is_child')
+        return super(CountingPerson, self).is_child()
+
+
+class PersonSerializer(Serializer):
+    full_name = Field()
+    is_child = Field()
+
+
+class LazyPersonSerializer(PersonSerializer):
+    class Meta:
+        lazy = True
+
+
+class LazyNestedObjectSerializer(ObjectSerializer):
+    class Meta:
+        nested = True
+        lazy = True
+
+
+class TestLazyRows(SerializationTestCase):
+    def setUp(self):
+        self.people = [CountingPerson('john', 'doe', 42), CountingPerson('jane', 'doe', 12)]
+
+    def test_fields_computed_on_access(self):
+        rows = list(LazyPersonSerializer().serialize('python', self.people))
+        self.assertEquals(rows[1]['full_name'], 'jane doe')
+        self.assertEquals([person._calls for person in self.people], [[], []])
+        self.assertEquals(rows[1]['is_child'], True)
+        self.assertEquals(rows[1]['is_child'], True)
+        self.assertEquals([person._calls for person in self.people], [[], ['is_child']])
+
+    def test_dict_conversion(self):
+        expected = {'full_name': 'john doe', 'is_child': False}
+        row = LazyPersonSerializer().serialize('python', self.people[0])
+        self.assertEquals(dict(row), expected)
+        self.assertEquals(dict(row.copy()), expected)
+
+        row = LazyPersonSerializer().serialize('python', self.people[0])
+        self.assertTrue(row == expected)
+        self.assertTrue(expected == row)
+        self.assertFalse(row != expected)
+        self.assertEquals(row.copy(), expected)
+
+    def test_yaml(self):
+        self.assertEquals(LazyPersonSerializer().serialize('yaml', self.people[0]),
+                          PersonSerializer().serialize('yaml', self.people[0]))
+        self.assertEquals(LazyPersonSerializer().serialize('yaml', self.people),
+                          PersonSerializer().serialize('yaml', self.people))
+
+    def test_csv_columns(self):
+        expected = 'full_name\r\njohn doe\r\njane doe\r\n'
+        output = LazyPersonSerializer().serialize('csv', self.people, columns=('full_name',))
+        self.assertEquals(output, expected)
+        self.assertEquals([person._calls for person in self.people], [[], []])
+
+    def test_same_output_as_eager(self):
+        john = Person('john', 'doe', 42)
+        jane = Person('jane', 'doe', 12, partner=john)
+        john.partner = jane
+        people = [john, jane]
+
+        expected = NestedObjectSerializer().serialize('json', people)
+        self.assertEquals(LazyNestedObjectSerializer().serialize('json', people), expected)
+
+        # Accessing the rows out of order gives the same values.
+        expected = list(NestedObjectSerializer().serialize('python', people))
+        rows = list(LazyNestedObjectSerializer().serialize('python', people))
+        self.assertEquals(rows[1]['partner'], expected[1]['partner'])
+        self.assertEquals(rows[0]['partner'], expected[0]['partner'])
+
+
+class RemotePerson(Person):
+    """
+    A person with a method that waits on a slow backend.
+    """
+    threads = set()
+
+    def avatar(self):
+        time.sleep(0.01)
+        RemotePerson.threads.add(threading.current_thread().ident)
+        return '%s.png' % self.first_name
+
+
+class RemotePersonSerializer(Serializer):
+    first_name = Field()
+    avatar = Field(io_bound=True)
+
+    class Meta:
+        io_workers = 4
+
+
+class TestIOBoundFields(SerializationTestCase):
+    def test_io_bound_field(self):
+        people = [RemotePerson('person%d' % index, 'doe', 42) for index in range(8)]
+        expected = [{'first_name': person.first_name, 'avatar': person.first_name + '.png'}
+                    for person in people]
+        RemotePerson.threads.clear()
+        self.assertEquals(RemotePersonSerializer().serialize('python', people), expected)
+        self.assertTrue(len(RemotePerson.threads) > 1)
+        self.assertFalse(threading.current_thread().ident in RemotePerson.threads)
+
+    def test_one_pool_per_serialization(self):
+        """
+        Every chunk and field shares the same pool of threads, which is shut
+        down once the output has been rendered.
+        """
+        pools = []
+
+        class ChunkedSerializer(RemotePersonSerializer):
+            large_avatar = Field(source='avatar', io_bound=True)
+
+            class Meta:
+                io_workers = 4
+                chunk_size = 2
+
+            def get_io_pool(self):
+                pools.append(super(ChunkedSerializer, self).get_io_pool())
+                return pools[-1]
+
+        people = [RemotePerson('person%d' % index, 'doe', 42) for index in range(8)]
+        serializer = ChunkedSerializer()
+        output = json.loads(serializer.serialize('json', people))
+        self.assertEquals([row['large_avatar'] for row in output],
+                          [person.first_name + '.png' for person in people])
+        self.assertEquals(len(pools), 8)
+        self.assertEquals(len(set(pools)), 1)
+        self.assertEquals(serializer.io_pool, None)
+
+
 class SerializerFieldTests(SerializationTestCase):
     """
     Tests declaring explicit fields on the serializer.
@@ -597,6 +918,22 @@ class TestSimpleModel(SerializationTestCase):
             serializers.serialize('xml', RaceEntry.objects.all())
         )
 
+    def test_dumpdata_xml_layout(self):
+        """
+        The field layout is computed once for each model, and reused.
+        """
+        RaceEntry.objects.create(
+            name='Jane doe',
+            runner_number=6015,
+            start_time=datetime.datetime(year=2012, month=4, day=30, hour=9),
+            finish_time=datetime.datetime(year=2012, month=4, day=30, hour=12, minute=30)
+        )
+        renderer = DumpDataXMLRenderer()
+        stream = StringIO()
+        renderer.render(self.dumpdata.serialize('python', RaceEntry.objects.all()), stream)
+        self.assertEquals(stream.getvalue(), serializers.serialize('xml', RaceEntry.objects.all()))
+        self.assertEquals(len(renderer.layouts), 1)
+
     def test_csv(self):
         expected = (
             "id,name,runner_number,start_time,finish_time\r\n"
@@ -633,12 +970,617 @@ class TestSimpleModel(SerializationTestCase):
         rhs = get_deserialized(RaceEntry.objects.all(), format='xml')
         self.assertTrue(deserialized_eq(lhs, rhs))
 
+    def test_dumpdata_deserialize_yaml(self):
+        lhs = list(get_deserialized(RaceEntry.objects.all(), format='yaml', serializer=self.dumpdata))
+        rhs = list(get_deserialized(RaceEntry.objects.all(), format='yaml'))
+        self.assertTrue(deserialized_eq(lhs, rhs))
+        self.assertEquals(
+            [(obj.object.name, obj.object.start_time) for obj in lhs],
+            [(obj.object.name, obj.object.start_time) for obj in rhs]
+        )
+
+    def test_libyaml(self):
+        self.assertEquals(
+            yaml.safe_load(self.dumpdata.serialize('yaml', RaceEntry.objects.all(), libyaml=True)),
+            yaml.safe_load(self.dumpdata.serialize('yaml', RaceEntry.objects.all()))
+        )
+
+    def test_streamed_rows_released(self):
+        """
+        Querysets are streamed without filling their result cache, so rows
+        that have been written out can be freed.
+        """
+        for index in range(99):
+            RaceEntry.objects.create(name='Runner %d' % index, runner_number=index,
+                                     start_time=datetime.datetime(2012, 4, 30, 9),
+                                     finish_time=datetime.datetime(2012, 4, 30, 12))
+        converted = []
+        alive = []
+
+        class TrackingSerializer(RaceEntrySerializer):
+            class Meta:
+                model = RaceEntry
+                chunk_size = 10
+
+            def convert_object(self, obj):
+                converted.append(weakref.ref(obj))
+                return super(TrackingSerializer, self).convert_object(obj)
+
+        class Stream(StringIO):
+            def write(self, data):
+                alive.append(len([ref for ref in converted if ref() is not None]))
+                StringIO.write(self, data)
+
+        TrackingSerializer().serialize('json', RaceEntry.objects.all(), stream=Stream(), write_size=1)
+        self.assertEquals(len(converted), 100)
+        self.assertTrue(max(alive) <= 20)
+
+    def test_repeated_objects(self):
+        """
+        Earlier objects in a list aren't ancestors of later ones, so the
+        same object may appear more than once.
+        """
+        entry = RaceEntry.objects.get()
+        output = list(self.serializer.serialize('python', [entry, entry]))
+        self.assertEquals(output[0], output[1])
+
     # def test_xml_parsing(self):
     #     data = self.dumpdata.serialize('xml', RaceEntry.objects.all())
     #     object = list(self.dumpdata.deserialize('xml', data))[0].object
     #     print repr((object.name, object.runner_number, object.start_time, object.finish_time))
 
 
+class TestCSVRenderer(SerializationTestCase):
+    def setUp(self):
+        self.rows = [
+            SortedDict([('id', 1), ('name', u'caf\xe9, bar'), ('score', 0.1), ('owner', None),
+                        ('author', SortedDict([('name', 'john'), ('age', 42)]))]),
+            SortedDict([('id', 2), ('name', 'x'), ('score', None), ('owner', 3),
+                        ('author', None)]),
+        ]
+
+    def render(self, rows, **opts):
+        stream = StringIO()
+        CSVRenderer().render(rows, stream, **opts)
+        return stream.getvalue()
+
+    def test_nested_columns(self):
+        expected = (
+            'id,name,score,owner,author.name,author.age\r\n'
+            '1,"caf\xc3\xa9, bar",0.1,None,john,42\r\n'
+            '2,x,None,3,,\r\n'
+        )
+        self.assertEquals(self.render(self.rows), expected)
+
+    def test_dotted_columns(self):
+        expected = 'author.age,id,missing\r\n42,1,\r\n,2,\r\n'
+        self.assertEquals(self.render(self.rows, columns=('author.age', 'id', 'missing')), expected)
+
+
+class TestHTMLRenderer(SerializationTestCase):
+    def setUp(self):
+        self.rows = [
+            SortedDict([('name', u'<b>%d</b>' % index), ('site', 'http://example.com/%d' % index),
+                        ('note', 'see www.example.com'), ('tags', [index])])
+            for index in range(5)
+        ]
+
+    def render(self, rows, **opts):
+        stream = StringIO()
+        HTMLRenderer().render(rows, stream, **opts)
+        return stream.getvalue()
+
+    def test_table(self):
+        output = self.render((row for row in self.rows), limit=2, page=2)
+        self.assertEquals(output, (
+            '<table>\n<thead><tr><th>name</th><th>site</th><th>note</th><th>tags</th></tr></thead>\n<tbody>\n'
+            '<tr><td>&lt;b&gt;2&lt;/b&gt;</td>'
+            '<td><a href="http://example.com/2">http://example.com/2</a></td>'
+            '<td>see <a href="http://www.example.com">www.example.com</a></td>'
+            '<td><ul>\n<li>2</li></ul>\n</td></tr>\n'
+            '<tr><td>&lt;b&gt;3&lt;/b&gt;</td>'
+            '<td><a href="http://example.com/3">http://example.com/3</a></td>'
+            '<td>see <a href="http://www.example.com">www.example.com</a></td>'
+            '<td><ul>\n<li>3</li></ul>\n</td></tr>\n'
+            '</tbody>\n</table>\n'
+        ))
+
+    def test_url_columns(self):
+        output = self.render(self.rows[:1], url_columns=('note',))
+        self.assertTrue('<td>http://example.com/0</td>' in output)
+        self.assertTrue('see <a href="http://www.example.com">' in output)
+
+    def test_nested_columns(self):
+        rows = [SortedDict([('id', 1), ('author', SortedDict([('name', 'john'), ('age', 42)]))]),
+                SortedDict([('id', 2), ('author', None)])]
+        self.assertEquals(self.render(rows), (
+            '<table>\n<thead><tr><th>id</th><th>author.name</th><th>author.age</th></tr></thead>\n'
+            '<tbody>\n<tr><td>1</td><td>john</td><td>42</td></tr>\n'
+            '<tr><td>2</td><td></td><td></td></tr>\n</tbody>\n</table>\n'
+        ))
+
+    def test_empty(self):
+        self.assertEquals(self.render([]), '<ul>\n</ul>\n')
+
+
+class Measurement(models.Model):
+    label = models.CharField(max_length=100)
+    value = models.IntegerField(null=True)
+    taken = models.DateTimeField(null=True)
+
+
+class MeasurementSerializer(ModelSerializer):
+    class Meta:
+        model = Measurement
+
+
+class TestYAMLParser(SerializationTestCase):
+    def test_streams_items(self):
+        """
+        The items of a top level list are yielded as they are parsed.
+        """
+        stream = StringIO(''.join(['- {id: %d, price: 1.50, name: "Runner %d"}\n' % (index, index)
+                                   for index in range(5000)]))
+        items = YAMLParser().parse(stream)
+        self.assertEquals(items.next(), {'id': 0, 'price': 1.5, 'name': 'Runner 0'})
+        self.assertTrue(stream.tell() < len(stream.getvalue()))
+        self.assertEquals(len(list(items)), 4999)
+
+    def test_mapping(self):
+        self.assertEquals(YAMLParser().parse(StringIO('a: [1, 2]\nb: {c: d}\n')),
+                          {'a': [1, 2], 'b': {'c': 'd'}})
+
+    def test_decimal_as_string(self):
+        obj = SortedDict([('price', Decimal('1.50'))])
+        for libyaml in (False, True):
+            output = ObjectSerializer().serialize('yaml', obj, libyaml=libyaml)
+            self.assertEquals(YAMLParser().parse(StringIO(output)), {'price': '1.50'})
+
+    def test_invalid(self):
+        self.assertRaises(DeserializationError, list, YAMLParser().parse(StringIO('- [1, 2\n- 3')))
+
+
+class TestCSVParser(SerializationTestCase):
+    def test_roundtrip(self):
+        Measurement.objects.create(label=u'caf\xe9', value=3,
+                                   taken=datetime.datetime(2012, 4, 30, 9, 30))
+        Measurement.objects.create(label='None', value=None, taken=None)
+        serializer = MeasurementSerializer()
+        data = serializer.serialize('csv', Measurement.objects.all())
+        objects = [item.object for item in serializer.deserialize('csv', data)]
+        self.assertEquals(
+            [(obj.pk, obj.label, obj.value, obj.taken) for obj in objects],
+            [(1, u'caf\xe9', 3, datetime.datetime(2012, 4, 30, 9, 30)), (2, u'None', None, None)]
+        )
+
+    def test_many_to_many_roundtrip(self):
+        author = Author.objects.create(name='None')
+        other = Author.objects.create(name='jane')
+        book = Book.objects.create(title='Unknown', in_stock=True)
+        book.authors = [author, other]
+        Book.objects.create(title='Anthology', in_stock=False)
+
+        serializer = BookSerializer()
+        data = serializer.serialize('csv', Book.objects.order_by('pk'))
+        objects = list(serializer.deserialize('csv', data))
+        self.assertEquals([(item.object.title, item.m2m_data['authors']) for item in objects],
+                          [(u'Unknown', [1, 2]), (u'Anthology', [])])
+
+        data = AuthorSerializer().serialize('csv', Author.objects.order_by('pk'))
+        names = [item.object.name for item in AuthorSerializer().deserialize('csv', data)]
+        self.assertEquals(names, [u'None', u'jane'])
+
+    def test_invalid_list(self):
+        data = 'id,title,in_stock,authors\r\n1,Unknown,True,1\r\n'
+        self.assertRaises(ValidationError, list, BookSerializer().deserialize('csv', data))
+
+    def test_empty_values(self):
+        """
+        Empty cells are None for nullable fields that can't be empty strings.
+        """
+        data = 'label,value,taken\r\n,,\r\n'
+        obj = list(MeasurementSerializer().deserialize('csv', data))[0].object
+        self.assertEquals((obj.label, obj.value, obj.taken), (u'', None, None))
+
+    def test_streams_rows(self):
+        stream = StringIO('id,author.name,author.age\r\n' +
+                          ''.join(['%d,john,%d\r\n' % (index, index) for index in range(1000)]))
+        rows = CSVParser().parse(stream)
+        self.assertEquals(rows.next(), {'id': u'0', 'author': {'name': u'john', 'age': u'0'}})
+        self.assertTrue(stream.tell() < len(stream.getvalue()))
+        self.assertEquals(len(list(rows)), 999)
+
+
+class TestDumpDataXMLParser(SerializationTestCase):
+    def test_streams_objects(self):
+        """
+        Objects are yielded as they are parsed, without reading the whole
+        document first.
+        """
+        body = ''.join(['<object pk="%d" model="serializers.raceentry">'
+                        '<field type="CharField" name="name">Runner %d &amp; co</field>'
+                        '<field name="tags" rel="ManyToManyRel" to="serializers.tag">'
+                        '<object pk="1"></object><object pk="2"></object></field>'
+                        '<field name="owner" rel="ManyToOneRel" to="auth.user"><None></None></field>'
+                        '</object>' % (index, index) for index in range(50)])
+        stream = StringIO('<?xml version="1.0" encoding="utf-8"?>\n'
+                          '<django-objects version="1.0">%s</django-objects>' % body)
+
+        class Parser(DumpDataXMLParser):
+            buffer_size = 100
+
+        objects = Parser().parse(stream)
+        self.assertEquals(objects.next(), {
+            'pk': u'0',
+            'model': u'serializers.raceentry',
+            'fields': {u'name': u'Runner 0 & co', u'tags': [u'1', u'2'], u'owner': None}
+        })
+        self.assertTrue(stream.tell() < len(stream.getvalue()))
+        self.assertEquals(len(list(objects)), 49)
+
+    def test_missing_field_name(self):
+        stream = StringIO('<django-objects version="1.0"><object model="serializers.raceentry">'
+                          '<field>1</field></object></django-objects>')
+        self.assertRaises(DeserializationError, list, DumpDataXMLParser().parse(stream))
+
+
+class StdlibLibraryJSONBackend(LibraryJSONBackend):
+    """
+    Exercises the library adapter code path, using the standard library.
+    """
+    module_name = 'json'
+
+    def dumps(self, obj, sort_keys=False):
+        return self.module.dumps(obj, sort_keys=sort_keys)
+
+
+class LibraryRaceEntrySerializer(RaceEntrySerializer):
+    class Meta:
+        model = RaceEntry
+        json_backend = StdlibLibraryJSONBackend
+
+
+class SimpleJSONRaceEntrySerializer(RaceEntrySerializer):
+    class Meta:
+        model = RaceEntry
+        json_backend = 'simplejson'
+
+
+class TestJSONBackends(SerializationTestCase):
+    def setUp(self):
+        for index in range(3):
+            RaceEntry.objects.create(
+                name=u'Runner \xe9 %d' % index,
+                runner_number=index,
+                start_time=datetime.datetime(year=2012, month=4, day=30, hour=9, microsecond=123456),
+                finish_time=datetime.datetime(year=2012, month=4, day=30, hour=12)
+            )
+
+    def test_library_backend(self):
+        queryset = RaceEntry.objects.all()
+        for options in ({}, {'sort_keys': True}, {'indent': 4}):
+            self.assertEquals(
+                LibraryRaceEntrySerializer().serialize('json', queryset, **options),
+                RaceEntrySerializer().serialize('json', queryset, **options)
+            )
+
+    def test_library_backend_deserialize(self):
+        data = RaceEntrySerializer().serialize('json', RaceEntry.objects.all())
+        self.assertEquals(
+            [obj.object.name for obj in LibraryRaceEntrySerializer().deserialize('json', data)],
+            [entry.name for entry in RaceEntry.objects.all()]
+        )
+
+    @unittest.skipIf(simplejson is None, 'simplejson is not installed')
+    def test_simplejson_backend(self):
+        queryset = RaceEntry.objects.all()
+        for options in ({}, {'sort_keys': True}, {'indent': 4}):
+            self.assertEquals(
+                SimpleJSONRaceEntrySerializer().serialize('json', queryset, **options),
+                RaceEntrySerializer().serialize('json', queryset, **options)
+            )
+
+    @unittest.skipIf(simplejson is None, 'simplejson is not installed')
+    def test_simplejson_formatting(self):
+        """
+        Dates, decimals and floats are formatted as by the default backend.
+        """
+        def rows():
+            return [
+                SortedDict([('price', Decimal('1.20')), ('big', 2 ** 70),
+                            ('floats', [0.1, 1.5, 1e20, 1e-07, 123456789.123456789]),
+                            ('when', datetime.datetime(2012, 4, 30, 9, 0, 0, 123456)),
+                            ('day', datetime.date(2012, 4, 30)), ('time', datetime.time(9, 30)),
+                            ('items', (value for value in range(2)))]),
+                {'b': 2, 'a': 1},
+                None,
+            ]
+
+        for sort_keys in (False, True):
+            self.assertEquals(
+                ''.join(SimpleJSONBackend().iterencode(rows(), sort_keys=sort_keys)),
+                ''.join(JSONBackend().iterencode(rows(), sort_keys=sort_keys))
+            )
+
+    def test_row_fragments(self):
+        """
+        Lists of objects encoded from pre-encoded key fragments match the
+        output of the generic encoder.
+        """
+        def rows():
+            return [
+                SortedDict([('id', 1), (u'n\xe4me', u'\xe9"\n'), ('score', 1.5), ('ok', True),
+                            ('none', None), ('big', 2 ** 70), ('price', Decimal('1.20')),
+                            ('when', datetime.datetime(2012, 4, 30, 9, 0, 0, 123456)),
+                            ('day', datetime.date(2012, 4, 30)), ('nested', {'a': [1, 2]}),
+                            ('items', (value for value in range(2)))]),
+                {'b': 2, 'a': 1},
+                {1: 'non string key'},
+                {},
+                [1, 'not an object'],
+                None,
+            ]
+
+        for sort_keys in (False, True):
+            self.assertEquals(
+                ''.join(JSONBackend().iterencode(rows(), sort_keys=sort_keys)),
+                DjangoJSONEncoder(sort_keys=sort_keys).encode(rows())
+            )
+
+    def test_backend_setting(self):
+        queryset = RaceEntry.objects.all()
+        expected = RaceEntrySerializer().serialize('json', queryset)
+        with self.settings(SERIALIZERS_JSON_BACKEND='simplejson'):
+            # Falls back to the standard library if simplejson isn't installed.
+            self.assertEquals(json.loads(RaceEntrySerializer().serialize('json', queryset)),
+                              json.loads(expected))
+        with self.settings(SERIALIZERS_JSON_BACKEND='unknown'):
+            self.assertRaises(ImproperlyConfigured, RaceEntrySerializer().serialize, 'json', queryset)
+
+
+class TestSerializeMany(SerializationTestCase):
+    def setUp(self):
+        for index in range(3):
+            RaceEntry.objects.create(
+                name='Runner %d' % index,
+                runner_number=index,
+                start_time=datetime.datetime(year=2012, month=4, day=30, hour=9),
+                finish_time=datetime.datetime(year=2012, month=4, day=30, hour=12)
+            )
+
+    def assertRendersOnce(self, threads):
+        serializer = RaceEntrySerializer()
+        queryset = RaceEntry.objects.all()
+        targets = [('csv', StringIO()), ('json', StringIO(), {'indent': 2})]
+        with self.assertNumQueries(1):
+            values = serializer.serialize_many(targets, queryset, threads=threads)
+        self.assertEquals(values, [
+            serializer.serialize('csv', queryset),
+            serializer.serialize('json', queryset, indent=2)
+        ])
+
+    def test_serialize_many(self):
+        self.assertRendersOnce(threads=False)
+
+    def test_serialize_many_threaded(self):
+        self.assertRendersOnce(threads=True)
+
+    def test_rows_pushed_to_targets(self):
+        """
+        Each row is rendered to every target as it is produced.
+        """
+        produced = []
+        written = []
+
+        def items():
+            for index in range(3):
+                produced.append(index)
+                yield {'index': index}
+
+        class Stream(StringIO):
+            def __init__(self, name):
+                StringIO.__init__(self)
+                self.name = name
+
+            def write(self, data):
+                written.append((self.name, len(produced)))
+                StringIO.write(self, data)
+
+        class UnchunkedSerializer(ObjectSerializer):
+            class Meta:
+                chunk_size = 1
+
+        targets = [('xml', Stream('xml'), {'write_size': 1}),
+                   ('html', Stream('html'), {'write_size': 1})]
+        values = UnchunkedSerializer().serialize_many(targets, items())
+        self.assertEquals(values, [ObjectSerializer().serialize(format, list(items()))
+                                   for format in ('xml', 'html')])
+        self.assertTrue(('xml', 1) in written)
+        self.assertTrue(('html', 1) in written)
+
+    def test_yaml_rows(self):
+        serializer = FixtureSerializer()
+        queryset = RaceEntry.objects.all()
+        values = serializer.serialize_many([('yaml', StringIO()), ('xml', StringIO())], queryset)
+        self.assertEquals(values, [serializer.serialize('yaml', queryset),
+                                   serializer.serialize('xml', queryset)])
+
+    def test_nested_rows(self):
+        obj = [{'name': 'a', 'tags': ['x', 'y'], 'owner': {'email': 'tom@example.com'}}] * 2
+        formats = ('json', 'yaml', 'xml')
+        for threads in (False, True):
+            values = ObjectSerializer().serialize_many([(format, StringIO()) for format in formats],
+                                                       obj, threads=threads)
+            self.assertEquals(values, [ObjectSerializer().serialize(format, obj) for format in formats])
+
+    def test_read_only_rows(self):
+        """
+        Rows are shared between the targets, so renderers can't modify them.
+        """
+        class MutatingRenderer(BaseRenderer):
+            def write_row(self, row):
+                row['name'] = row['name'].upper()
+
+        class MutatingSerializer(RaceEntrySerializer):
+            class Meta:
+                model = RaceEntry
+                renderer_classes = {'mutate': MutatingRenderer}
+
+        for threads in (False, True):
+            self.assertRaises(TypeError, MutatingSerializer().serialize_many,
+                              [('mutate', StringIO())], RaceEntry.objects.all(), threads=threads)
+
+    def test_buffering_renderer(self):
+        """
+        Renderers that only implement `render` are passed all the rows at once.
+        """
+        class CountRenderer(BaseRenderer):
+            def render(self, obj, stream, **opts):
+                stream.write('%d rows' % len(obj))
+
+        class CountingSerializer(RaceEntrySerializer):
+            class Meta:
+                renderer_classes = {'count': CountRenderer, 'csv': CSVRenderer}
+
+        for threads in (False, True):
+            targets = [('count', StringIO()), ('csv', StringIO())]
+            values = CountingSerializer().serialize_many(targets, RaceEntry.objects.all(),
+                                                         threads=threads)
+            self.assertEquals(values[0], '3 rows')
+
+    def test_renderer_error(self):
+        class BrokenStream(object):
+            def write(self, data):
+                raise IOError('Broken stream')
+
+        targets = [('json', StringIO()), ('csv', BrokenStream())]
+        self.assertRaises(IOError, RaceEntrySerializer().serialize_many,
+                          targets, RaceEntry.objects.all(), threads=True)
+
+
+class TestBudget(SerializationTestCase):
+    def setUp(self):
+        for index, hour in enumerate([9, 11, 10, 9, 11, 9]):
+            RaceEntry.objects.create(
+                name='Runner %d' % index,
+                runner_number=index,
+                start_time=datetime.datetime(year=2012, month=4, day=30, hour=hour),
+                finish_time=datetime.datetime(year=2012, month=4, day=30, hour=12)
+            )
+        self.queryset = RaceEntry.objects.order_by('-start_time')
+
+    def get_pages(self, format, obj, **options):
+        serializer = RaceEntrySerializer()
+        pages = [serializer.serialize(format, obj, **options)]
+        while serializer.continuation is not None:
+            pages.append(serializer.serialize(format, obj, continuation=serializer.continuation, **options))
+        return pages
+
+    def test_max_objects(self):
+        pages = self.get_pages('json', self.queryset, max_objects=4)
+        pages = [json.loads(page) for page in pages]
+        self.assertEquals([len(page) for page in pages], [4, 2])
+        expected = list(self.queryset.order_by('-start_time', 'pk').values_list('runner_number', flat=True))
+        self.assertEquals([item['runner_number'] for page in pages for item in page], expected)
+
+    def test_max_objects_fetches_page(self):
+        """
+        Each page only fetches and prepares the objects that fit in it, and
+        one more to tell whether there are any more.
+        """
+        chunks = []
+
+        def name_lengths(entries):
+            chunks.append(len(entries))
+            return [len(entry.name) for entry in entries]
+
+        class PagedSerializer(RaceEntrySerializer):
+            name_length = BatchField(name_lengths)
+
+            class Meta:
+                model = RaceEntry
+
+        debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            for queryset in (self.queryset, RaceEntry.objects.order_by('pk')[:5]):
+                serializer = PagedSerializer()
+                del connection.queries[:]
+                del chunks[:]
+                serializer.serialize('python', queryset, max_objects=2)
+                serializer.serialize('python', queryset, max_objects=2,
+                                     continuation=serializer.continuation)
+                self.assertEquals([query['sql'].count('LIMIT 3') for query in connection.queries], [1, 1])
+                self.assertEquals(chunks, [2, 2])
+        finally:
+            connection.use_debug_cursor = debug_cursor
+
+    def test_rows_added_between_pages(self):
+        serializer = RaceEntrySerializer()
+        first = serializer.serialize('python', self.queryset, max_objects=3)
+        RaceEntry.objects.create(
+            name='Late runner',
+            runner_number=99,
+            start_time=datetime.datetime(year=2012, month=4, day=30, hour=11),
+            finish_time=datetime.datetime(year=2012, month=4, day=30, hour=12)
+        )
+        rest = list(serializer.serialize('python', self.queryset, continuation=serializer.continuation))
+        self.assertEquals(serializer.continuation, None)
+        names = [item['name'] for item in first + rest]
+        self.assertEquals(len(names), 6)
+        self.assertEquals(len(set(names)), 6)
+
+    def test_max_bytes(self):
+        pages = self.get_pages('csv', RaceEntry.objects.all(), max_bytes=150)
+        self.assertEquals(len(pages), 3)
+        rows = [row for page in pages for row in page.splitlines()[1:]]
+        self.assertEquals([row.split(',')[2] for row in rows], [str(index) for index in range(6)])
+
+    def test_max_bytes_json(self):
+        pages = self.get_pages('json', RaceEntry.objects.all(), max_bytes=300)
+        pages = [json.loads(page) for page in pages]
+        self.assertEquals([len(page) for page in pages], [3, 3])
+
+    def test_max_bytes_many_rows(self):
+        """
+        The limit applies however many rows there are, as bytes are counted
+        as the renderer writes them, not as they reach the stream.
+        """
+        for index in range(44):
+            RaceEntry.objects.create(name='Runner %d' % index, runner_number=index,
+                                     start_time=datetime.datetime(2012, 4, 30, 9),
+                                     finish_time=datetime.datetime(2012, 4, 30, 12))
+        serializer = RaceEntrySerializer()
+        output = serializer.serialize('json', RaceEntry.objects.all(), max_bytes=300)
+        self.assertEquals(len(json.loads(output)), 3)
+        self.assertNotEquals(serializer.continuation, None)
+
+        output = serializer.serialize('csv', RaceEntry.objects.all(), max_bytes=150)
+        self.assertEquals(len(output.splitlines()), 3)
+        self.assertNotEquals(serializer.continuation, None)
+
+        output = serializer.serialize('xml', RaceEntry.objects.all(), max_bytes=300)
+        self.assertEquals(output.count('<item>'), 2)
+        self.assertNotEquals(serializer.continuation, None)
+
+    def test_max_time(self):
+        serializer = RaceEntrySerializer()
+        serializer.serialize('python', self.queryset, max_time=0)
+        self.assertNotEquals(serializer.continuation, None)
+
+    def test_offset_continuation(self):
+        serializer = ObjectSerializer()
+        obj = [{'number': number} for number in range(5)]
+        first = serializer.serialize('python', obj, max_objects=3)
+        rest = list(serializer.serialize('python', obj, continuation=serializer.continuation))
+        self.assertEquals(first + rest, obj)
+
+    def test_invalid_continuation(self):
+        self.assertRaises(ValueError, RaceEntrySerializer().serialize,
+                          'json', self.queryset, continuation='invalid')
+
+
+
 class TestNullPKModel(SerializationTestCase):
     def setUp(self):
         self.dumpdata = FixtureSerializer()
@@ -728,6 +1670,58 @@ class TestModelInheritance(SerializationTestCase):
             expected
         )
 
+    def test_serialize_child_model_deferred_parent_fields(self):
+        """
+        Deferred fields are loaded for a whole chunk at once, including those
+        inherited from the parent model.
+        """
+        PremiumAccount.objects.create(
+            points=7,
+            company='Wibble Ltd.',
+            date_upgraded=datetime.datetime(year=2012, month=5, day=1, hour=9)
+        )
+        expected = self.serializer.serialize('json', PremiumAccount.objects.all())
+        queryset = PremiumAccount.objects.defer('points', 'company')
+        with self.assertNumQueries(2):
+            output = self.serializer.serialize('json', queryset)
+        self.assertEquals(output, expected)
+
+    def test_serialize_parent_model_with_child_fields(self):
+        """
+        Child instances are fetched for a whole chunk at once, when
+        serializing the parent model with fields from the child model.
+        """
+        class AccountSerializer(ModelSerializer):
+            premiumaccount = ModelSerializer()
+
+            class Meta:
+                model = Account
+
+        Account.objects.create(points=7, company='Wibble Ltd.')
+        expected = [{
+            'id': 1,
+            'points': 42,
+            'company': 'Foozle Inc.',
+            'premiumaccount': {
+                'id': 1,
+                'points': 42,
+                'company': 'Foozle Inc.',
+                'date_upgraded': datetime.datetime(2012, 4, 30, 9, 0)
+            }
+        }, {
+            'id': 2,
+            'points': 7,
+            'company': 'Wibble Ltd.',
+            'premiumaccount': None
+        }]
+        with self.assertNumQueries(2):
+            output = expand(AccountSerializer().serialize('python', Account.objects.all()))
+        self.assertEquals(output, expected)
+
+        # A single instance without a child gives the same output.
+        output = AccountSerializer().serialize('python', Account.objects.get(pk=2))
+        self.assertEquals(output, expected[1])
+
     def test_modelserializer_deserialize(self):
         lhs = get_deserialized(PremiumAccount.objects.all(), serializer=self.serializer)
         rhs = get_deserialized(PremiumAccount.objects.all())
@@ -888,6 +1882,55 @@ class TestNaturalKey(SerializationTestCase):
 
 ##### One to one relationships #####
 
+class TestUsing(SerializationTestCase):
+    multi_db = True
+
+    def setUp(self):
+        for db, first_name in (('default', 'joe'), ('replica', 'jim')):
+            owner = PetOwner.objects.using(db).create(
+                first_name=first_name,
+                last_name='adams',
+                birthdate=datetime.date(year=1965, month=8, day=27)
+            )
+            Pet.objects.using(db).create(owner=owner, name='splash gordon')
+
+    def test_serialize_using(self):
+        class PetSerializer(ModelSerializer):
+            owner = NaturalKeyRelatedField()
+
+            class Meta:
+                model = Pet
+
+        expected = [{'id': 1, 'name': 'splash gordon', 'owner': ('jim', 'adams')}]
+        output = PetSerializer().serialize('python', Pet.objects.all(), using='replica')
+        self.assertEquals(output, expected)
+
+        # Instances loaded from another database are related to objects
+        # on the `using` database.
+        output = PetSerializer().serialize('python', list(Pet.objects.all()), using='replica')
+        self.assertEquals(output, expected)
+
+    def test_serialize_reverse_relation_using(self):
+        class PetOwnerSerializer(ModelSerializer):
+            pets = NaturalKeyRelatedField()
+
+            class Meta:
+                model = PetOwner
+                fields = ('first_name', 'pets')
+
+        PetOwner.objects.get().pets.create(name='frogger')
+        expected = {'first_name': 'joe', 'pets': ['splash gordon']}
+        output = PetOwnerSerializer().serialize('python', PetOwner.objects.get(), using='replica')
+        self.assertEquals(output, expected)
+
+    def test_deserialize_using(self):
+        PetOwner.objects.using('replica').filter(first_name='jim').update(first_name='joe')
+        data = FixtureSerializer().serialize('json', Pet.objects.all(), use_natural_keys=True)
+        PetOwner.objects.using('replica').update(id=5)
+        obj = list(FixtureSerializer().deserialize('json', data, using='replica'))[0].object
+        self.assertEquals(obj.owner_id, 5)
+
+
 class User(models.Model):
     email = models.EmailField()
 
@@ -1053,6 +2096,17 @@ class NestedVehicleSerializer(ModelSerializer):
         nested = True
 
 
+class Delivery(models.Model):
+    courier = models.ForeignKey(Owner, null=True, related_name='deliveries')
+    address = models.CharField(max_length=100)
+
+
+class NestedDeliverySerializer(ModelSerializer):
+    class Meta:
+        model = Delivery
+        nested = True
+
+
 class TestFKModel(SerializationTestCase):
     """
     Test one-to-one field relationship on a model.
@@ -1108,6 +2162,81 @@ class TestFKModel(SerializationTestCase):
             expected
         )
 
+    def test_fk_nested_shared_instance(self):
+        """
+        Related instances that are referenced by several objects are only
+        fetched once per call to serialize(), and yield identical output.
+        """
+        owner = {
+            'id': 1,
+            'email': u'tom@example.com'
+        }
+        expected = [
+            {
+                'id': 1,
+                'owner': owner,
+                'licence': u'DJANGO42',
+                'date_of_manufacture': datetime.date(day=6, month=6, year=2005)
+            }, {
+                'id': 2,
+                'owner': owner,
+                'licence': u'',
+                'date_of_manufacture': datetime.date(day=8, month=8, year=1990)
+            }
+        ]
+        with self.assertNumQueries(2):
+            output = expand(self.nested_model.serialize('python', Vehicle.objects.all()))
+        self.assertEquals(output, expected)
+
+    def test_identity_map_size(self):
+        """
+        Only the most recently used nested instances are kept, so an owner
+        is fetched again once it has been pushed out of the identity map.
+        """
+        class SmallMapVehicleSerializer(ModelSerializer):
+            class Meta:
+                model = Vehicle
+                nested = True
+                identity_map_size = 1
+
+        ann = Owner.objects.create(email='ann@example.com')
+        Vehicle.objects.create(owner=ann, licence='PYTHON27',
+                               date_of_manufacture=datetime.date(2007, 7, 7))
+        Vehicle.objects.create(owner=self.owner, licence='DJANGO14',
+                               date_of_manufacture=datetime.date(2012, 3, 23))
+        queryset = Vehicle.objects.order_by('pk')
+        with self.assertNumQueries(4):
+            output = expand(SmallMapVehicleSerializer().serialize('python', queryset))
+        self.assertEquals(output, expand(self.nested_model.serialize('python', queryset)))
+
+    def test_fk_nested_shared_instance_json(self):
+        output = self.nested_model.serialize('json', Vehicle.objects.all())
+        self.assertEquals(output.count('tom@example.com'), 2)
+
+    def test_fk_nested_shared_instance_yaml(self):
+        output = self.nested_model.serialize('yaml', Vehicle.objects.all())
+        self.assertEquals(output.count('tom@example.com'), 2)
+        self.assertFalse('&id' in output or '*id' in output)
+
+    def test_fk_nested_null_csv(self):
+        """
+        A null foreign key in the first row still gets a column for each
+        field of the related object.
+        """
+        Delivery.objects.create(courier=None, address='1 Main St')
+        Delivery.objects.create(courier=self.owner, address='2 Main St')
+        expected = (
+            'id,courier.id,courier.email,address\r\n'
+            '1,,,1 Main St\r\n'
+            '2,1,tom@example.com,2 Main St\r\n'
+        )
+        output = NestedDeliverySerializer().serialize('csv', Delivery.objects.order_by('pk'))
+        self.assertEquals(output, expected)
+
+        output = NestedDeliverySerializer().serialize('html', Delivery.objects.order_by('pk'))
+        self.assertTrue('<th>id</th><th>courier.id</th><th>courier.email</th><th>address</th>' in output)
+        self.assertTrue('<tr><td>2</td><td>1</td><td>' in output)
+
     def test_fk_flat(self):
         expected = {
             'id': 1,
@@ -1172,6 +2301,325 @@ class TestFKModel(SerializationTestCase):
         )
 
 
+class TestRecordSources(SerializationTestCase):
+    """
+    Test serializing dicts, named tuples and `values()` rows as records.
+    """
+    def setUp(self):
+        self.owner = Owner.objects.create(email='tom@example.com')
+        Vehicle.objects.create(
+            owner=self.owner,
+            licence='DJANGO42',
+            date_of_manufacture=datetime.date(day=6, month=6, year=2005)
+        )
+
+    def test_dict_records(self):
+        class LicenceSerializer(Serializer):
+            licence = Field()
+            manufactured = Field(source='date')
+
+        rows = [
+            {'licence': 'DJANGO42', 'date': datetime.date(2005, 6, 6), 'other': 1},
+            {'licence': 'PYTHON27', 'date': datetime.date(2007, 7, 7), 'other': 2}
+        ]
+        expected = [
+            {'licence': 'DJANGO42', 'manufactured': datetime.date(2005, 6, 6)},
+            {'licence': 'PYTHON27', 'manufactured': datetime.date(2007, 7, 7)}
+        ]
+        self.assertEquals(LicenceSerializer().serialize('python', rows, records=True), expected)
+
+    def test_dict_containers(self):
+        """
+        Dicts that aren't `values()` rows are still containers by default.
+        """
+        output = VehicleSerializer().serialize('json', {'results': Vehicle.objects.all(), 'count': 1})
+        self.assertEquals(json.loads(output), {
+            'count': 1,
+            'results': json.loads(VehicleSerializer().serialize('json', Vehicle.objects.all()))
+        })
+
+        person = Person('john', 'doe', 42)
+        output = PersonSerializer().serialize('python', {'people': [person]})
+        self.assertEquals(expand(output), {'people': [{'full_name': 'john doe', 'is_child': False}]})
+
+        output = VehicleSerializer().serialize('python', {'results': Vehicle.objects.values()})
+        self.assertEquals(expand(output), {
+            'results': expand(VehicleSerializer().serialize('python', Vehicle.objects.all()))
+        })
+
+    def test_named_tuple_records(self):
+        Row = collections.namedtuple('Row', ('licence', 'owner'))
+
+        class OwnerSerializer(Serializer):
+            email = Field()
+
+        class LicenceSerializer(Serializer):
+            licence = Field()
+            owner = OwnerSerializer()
+
+        rows = [Row('DJANGO42', {'email': 'tom@example.com'})]
+        expected = [{'licence': 'DJANGO42', 'owner': {'email': 'tom@example.com'}}]
+        self.assertEquals(LicenceSerializer().serialize('python', rows), expected)
+
+    def test_values_rows(self):
+        self.assertEquals(
+            VehicleSerializer().serialize('json', Vehicle.objects.values()),
+            VehicleSerializer().serialize('json', Vehicle.objects.all())
+        )
+
+    def test_values_annotate_rows(self):
+        class OwnerSerializer(ModelSerializer):
+            class Meta:
+                model = Owner
+
+        rows = Owner.objects.values('email').annotate(vehicle_count=Count('vehicles'))
+        expected = [{'email': u'tom@example.com', 'vehicle_count': 1}]
+        self.assertEquals(OwnerSerializer().serialize('python', rows), expected)
+
+
+def count_vehicles(owners):
+    counts = dict(Owner.objects.filter(pk__in=[owner.pk for owner in owners])
+                  .annotate(count=Count('vehicles')).values_list('pk', 'count'))
+    return [counts[owner.pk] for owner in owners]
+
+
+class BatchOwnerSerializer(ModelSerializer):
+    vehicle_count = BatchField(count_vehicles)
+    licences = BatchField('get_licences')
+
+    class Meta:
+        model = Owner
+
+    def get_licences(self, owners):
+        licences = dict([(owner.pk, []) for owner in owners])
+        for owner_id, licence in Vehicle.objects.filter(owner__in=owners).values_list('owner', 'licence'):
+            licences[owner_id].append(licence)
+        return [licences[owner.pk] for owner in owners]
+
+
+class TestBatchField(SerializationTestCase):
+    def setUp(self):
+        for index in range(3):
+            owner = Owner.objects.create(email='owner%d@example.com' % index)
+            for number in range(index):
+                Vehicle.objects.create(owner=owner, licence='%d-%d' % (index, number),
+                                       date_of_manufacture=datetime.date(2012, 1, 1))
+
+    def test_batch_field(self):
+        expected = [
+            {'id': 1, 'email': 'owner0@example.com', 'vehicle_count': 0, 'licences': []},
+            {'id': 2, 'email': 'owner1@example.com', 'vehicle_count': 1, 'licences': ['1-0']},
+            {'id': 3, 'email': 'owner2@example.com', 'vehicle_count': 2, 'licences': ['2-0', '2-1']},
+        ]
+        with self.assertNumQueries(3):
+            output = list(BatchOwnerSerializer().serialize('python', Owner.objects.order_by('pk')))
+        self.assertEquals(output, expected)
+
+    def test_single_object(self):
+        expected = {'id': 3, 'email': 'owner2@example.com', 'vehicle_count': 2, 'licences': ['2-0', '2-1']}
+        output = BatchOwnerSerializer().serialize('python', Owner.objects.get(pk=3))
+        self.assertEquals(output, expected)
+
+    def test_wrong_number_of_values(self):
+        class ShortOwnerSerializer(ModelSerializer):
+            vehicle_count = BatchField(lambda owners: count_vehicles(owners)[:-1])
+
+            class Meta:
+                model = Owner
+
+        self.assertRaises(ValueError, list,
+                          ShortOwnerSerializer().serialize('python', Owner.objects.all()))
+
+
+class AggregateOwnerSerializer(ModelSerializer):
+    vehicle_count = AggregateField(Count('vehicles'))
+
+    class Meta:
+        model = Owner
+
+
+class TestAggregateField(SerializationTestCase):
+    def setUp(self):
+        for index in range(3):
+            owner = Owner.objects.create(email='owner%d@example.com' % index)
+            for number in range(index):
+                Vehicle.objects.create(owner=owner, licence='%d-%d' % (index, number),
+                                       date_of_manufacture=datetime.date(2012, 1, 1))
+
+    def test_annotated_queryset(self):
+        expected = [
+            {'id': 1, 'email': 'owner0@example.com', 'vehicle_count': 0},
+            {'id': 2, 'email': 'owner1@example.com', 'vehicle_count': 1},
+            {'id': 3, 'email': 'owner2@example.com', 'vehicle_count': 2},
+        ]
+        with self.assertNumQueries(1):
+            output = list(AggregateOwnerSerializer().serialize('python', Owner.objects.order_by('pk')))
+        self.assertEquals(output, expected)
+
+    def test_values_queryset(self):
+        expected = [
+            {'id': 1, 'email': 'owner0@example.com', 'vehicle_count': 0},
+            {'id': 2, 'email': 'owner1@example.com', 'vehicle_count': 1},
+            {'id': 3, 'email': 'owner2@example.com', 'vehicle_count': 2},
+        ]
+        rows = Owner.objects.order_by('pk').values('id', 'email')
+        self.assertEquals(AggregateOwnerSerializer().serialize('python', rows), expected)
+
+    def test_values_queryset_without_pk(self):
+        """
+        Annotating would group rows by the selected columns, merging any
+        duplicates, so values() without the primary key isn't annotated.
+        """
+        Owner.objects.create(email='owner0@example.com')
+        rows = Owner.objects.order_by('pk').values('email')
+
+        class EmailSerializer(AggregateOwnerSerializer):
+            class Meta:
+                model = Owner
+                exclude = ('vehicle_count',)
+
+        output = EmailSerializer().serialize('python', rows)
+        self.assertEquals([row['email'] for row in output],
+                          ['owner0@example.com', 'owner1@example.com',
+                           'owner2@example.com', 'owner0@example.com'])
+        self.assertRaises(ValueError, list, AggregateOwnerSerializer().serialize('python', rows))
+
+    def test_single_object(self):
+        expected = {'id': 3, 'email': 'owner2@example.com', 'vehicle_count': 2}
+        output = AggregateOwnerSerializer().serialize('python', Owner.objects.get(pk=3))
+        self.assertEquals(output, expected)
+
+
+class ReferenceVehicleSerializer(ModelSerializer):
+    class Meta:
+        model = Vehicle
+        nested = True
+        references = True
+
+
+class TestReferences(SerializationTestCase):
+    """
+    Test the `references` option, which emits shared nested objects once.
+    """
+    def setUp(self):
+        self.owner = Owner.objects.create(email='tom@example.com')
+        for licence in ('DJANGO42', 'PYTHON27'):
+            Vehicle.objects.create(
+                owner=self.owner,
+                licence=licence,
+                date_of_manufacture=datetime.date(day=6, month=6, year=2005)
+            )
+
+    def test_references_serialize(self):
+        expected = {
+            'data': [
+                {
+                    'id': 1,
+                    'owner': {'$ref': u'serializers.owner:1'},
+                    'licence': u'DJANGO42',
+                    'date_of_manufacture': datetime.date(day=6, month=6, year=2005)
+                }, {
+                    'id': 2,
+                    'owner': {'$ref': u'serializers.owner:1'},
+                    'licence': u'PYTHON27',
+                    'date_of_manufacture': datetime.date(day=6, month=6, year=2005)
+                }
+            ],
+            'objects': {
+                u'serializers.owner:1': {'id': 1, 'email': u'tom@example.com'}
+            }
+        }
+        self.assertEquals(
+            ReferenceVehicleSerializer().serialize('python', Vehicle.objects.all()),
+            expected
+        )
+
+    def test_references_json(self):
+        output = ReferenceVehicleSerializer().serialize('json', Vehicle.objects.all())
+        self.assertEquals(output.count('tom@example.com'), 1)
+
+    def test_references_deserialize(self):
+        class OwnerSerializer(Serializer):
+            email = Field()
+
+        class VehicleSerializer(Serializer):
+            licence = Field()
+            owner = OwnerSerializer()
+
+            class Meta:
+                references = True
+
+        serialized = ReferenceVehicleSerializer().serialize('json', Vehicle.objects.all())
+        objects = list(VehicleSerializer().deserialize('json', serialized))
+        self.assertEquals(objects, [
+            {'licence': u'DJANGO42', 'owner': {'email': u'tom@example.com'}},
+            {'licence': u'PYTHON27', 'owner': {'email': u'tom@example.com'}}
+        ])
+
+    def test_malformed_references(self):
+        class VehicleSerializer(Serializer):
+            licence = Field()
+
+            class Meta:
+                references = True
+
+        for objects in ({'a': {'$ref': 'a'}}, {'a': {'next': {'$ref': 'b'}}, 'b': [{'$ref': 'a'}]}, {}):
+            serialized = json.dumps({'data': [{'licence': 'DJANGO42', 'owner': {'$ref': 'a'}}],
+                                     'objects': objects})
+            self.assertRaises(DeserializationError, VehicleSerializer().deserialize, 'json', serialized)
+
+
+class TaggedItem(models.Model):
+    tag = models.CharField(max_length=30)
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey()
+
+
+class TaggedItemSerializer(ModelSerializer):
+    content_object = GenericForeignKeyField()
+
+    class Meta:
+        model = TaggedItem
+        exclude = ('content_type', 'object_id')
+
+
+class TestGenericForeignKey(SerializationTestCase):
+    def setUp(self):
+        tom = Owner.objects.create(email='tom@example.com')
+        ann = Owner.objects.create(email='ann@example.com')
+        car = Vehicle.objects.create(
+            owner=tom,
+            licence='DJANGO42',
+            date_of_manufacture=datetime.date(day=6, month=6, year=2005)
+        )
+        for tag, obj in (('fast', car), ('owner', tom), ('owner', ann)):
+            TaggedItem.objects.create(tag=tag, content_object=obj)
+
+    def test_generic_foreign_key(self):
+        expected = [
+            {'id': 1, 'tag': 'fast', 'content_object': {'model': 'serializers.vehicle', 'pk': 1}},
+            {'id': 2, 'tag': 'owner', 'content_object': {'model': 'serializers.owner', 'pk': 1}},
+            {'id': 3, 'tag': 'owner', 'content_object': {'model': 'serializers.owner', 'pk': 2}}
+        ]
+        # One query for the tagged items, and one per related model.
+        with self.assertNumQueries(3):
+            output = expand(TaggedItemSerializer().serialize('python', TaggedItem.objects.all()))
+        self.assertEquals(output, expected)
+
+    def test_generic_foreign_key_deserialize(self):
+        serialized = TaggedItemSerializer().serialize('json', TaggedItem.objects.all())
+        objects = list(TaggedItemSerializer().deserialize('json', serialized))
+        self.assertEquals(objects[1].object.content_object, Owner.objects.get(pk=1))
+        self.assertEquals(objects[2].object.object_id, 2)
+
+    def test_generic_foreign_key_values_queryset(self):
+        queryset = TaggedItem.objects.values('id', 'tag', 'content_type', 'object_id')
+        output = expand(TaggedItemSerializer().serialize('python', queryset))
+        self.assertEquals(output[0]['content_object'], {'model': 'serializers.vehicle', 'pk': 1})
+        self.assertEquals(output[2]['content_object'], {'model': 'serializers.owner', 'pk': 2})
+
+
 class Author(models.Model):
     name = models.CharField(max_length=100)
 
@@ -1182,6 +2630,11 @@ class Book(models.Model):
     in_stock = models.BooleanField()
 
 
+class AuthorSerializer(ModelSerializer):
+    class Meta:
+        model = Author
+
+
 class BookSerializer(ModelSerializer):
     class Meta:
         model = Book
@@ -1418,6 +2871,54 @@ class FileFieldTests(SerializationTestCase):
         )
 
 
+attachment_storage = FileSystemStorage(location=tempfile.mkdtemp())
+
+
+class Attachment(models.Model):
+    data = models.FileField(upload_to='attachments', storage=attachment_storage)
+
+
+class AttachmentSerializer(ModelSerializer):
+    data = Base64FileField(chunk_size=4)
+
+    class Meta:
+        model = Attachment
+
+
+class TestEmbeddedFiles(SerializationTestCase):
+    def setUp(self):
+        self.attachment = Attachment()
+        self.attachment.data.save('hello.txt', ContentFile('hello world!!'))
+
+    def test_serialize_embedded_file(self):
+        expected = {
+            'id': self.attachment.id,
+            'data': {
+                'name': self.attachment.data.name,
+                'content': 'aGVsbG8gd29ybGQhIQ=='
+            }
+        }
+        output = AttachmentSerializer().serialize('json', self.attachment)
+        self.assertEquals(json.loads(output), expected)
+
+    def test_deserialize_embedded_file(self):
+        data = {
+            'id': 2,
+            'data': {'name': 'attachments/copy.txt', 'content': 'aGVsbG8gd29ybGQhIQ=='}
+        }
+        restored = AttachmentSerializer().deserialize('python', data)
+        self.assertEquals(restored.object.data.read(), 'hello world!!')
+
+    def test_fixture_roundtrip(self):
+        for format in ('json', 'xml'):
+            output = FixtureSerializer().serialize(format, Attachment.objects.all(),
+                                                   embed_files=True)
+            self.assertTrue('aGVsbG8gd29ybGQhIQ==' in output)
+            obj = list(FixtureSerializer().deserialize(format, output))[0].object
+            self.assertNotEquals(obj.data.name, self.attachment.data.name)
+            self.assertEquals(obj.data.read(), 'hello world!!')
+
+
 class Category(models.Model):
     name = models.CharField(max_length=20)
 
@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
+from django.core.files.base import File
+from django.core.serializers.base import DeserializationError
 from django.utils.datastructures import SortedDict
 from django.utils.timezone import is_aware
 
+import base64
+import collections
 import csv
 import datetime
 import decimal
 import inspect
+import itertools
+import json
+import time
 import types
-from django.utils import simplejson as json
+from xml.sax.saxutils import escape, quoteattr
 
 
 def is_simple_callable(obj):
@@ -33,18 +40,459 @@ class SortedDictWithMetadata(SortedDict, DictWithMetadata):
     pass
 
 
+def _read_only(self, *args, **kwargs):
+    raise TypeError('%s is read-only' % self.__class__.__name__)
+
+
+class FrozenDictWithMetadata(SortedDictWithMetadata):
+    """
+    A read-only SortedDictWithMetadata, for rows that are shared between
+    renderers.
+    """
+    __setitem__ = __delitem__ = _read_only
+    pop = popitem = setdefault = update = clear = insert = _read_only
+
+
+class FrozenList(list):
+    """
+    A read-only list, for rows that are shared between renderers.
+    """
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _read_only
+    __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+
+
+class LazyDictWithMetadata(collections.MutableMapping):
+    """
+    An ordered mapping, like SortedDictWithMetadata, whose values may be
+    computed on first access, and are then cached.
+
+    This isn't a dict subclass, as `dict(row)` and dict comparisons read a
+    dict's storage directly, and would miss the values yet to be computed.
+    Use `is_mapping` rather than checking for dicts where rows may be lazy.
+    """
+    def __init__(self):
+        self.keyOrder = []
+        self.values_by_key = {}
+        self.pending = {}
+        self.metadata = {}
+
+    def set_lazy(self, key, compute):
+        """
+        Set the value for `key` to the result of calling `compute`, when it
+        is first needed.
+        """
+        if key not in self:
+            self.keyOrder.append(key)
+        self.values_by_key.pop(key, None)
+        self.pending[key] = compute
+
+    def __getitem__(self, key):
+        try:
+            return self.values_by_key[key]
+        except KeyError:
+            value = self.pending[key]()
+            del self.pending[key]
+            self.values_by_key[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.keyOrder.append(key)
+        self.pending.pop(key, None)
+        self.values_by_key[key] = value
+
+    def __delitem__(self, key):
+        if key in self.pending:
+            del self.pending[key]
+        else:
+            del self.values_by_key[key]
+        self.keyOrder.remove(key)
+
+    def __contains__(self, key):
+        return key in self.values_by_key or key in self.pending
+
+    def __iter__(self):
+        return iter(self.keyOrder)
+
+    def __len__(self):
+        return len(self.keyOrder)
+
+    def keys(self):
+        return self.keyOrder[:]
+
+    def copy(self):
+        """
+        Return a copy, whose pending values are computed independently.
+        """
+        obj = self.__class__()
+        obj.__dict__.update(self.__dict__)
+        obj.keyOrder = self.keyOrder[:]
+        obj.values_by_key = self.values_by_key.copy()
+        obj.pending = self.pending.copy()
+        return obj
+
+    def __repr__(self):
+        return '{%s}' % ', '.join(['%r: %r' % (key, value) for key, value in self.items()])
+
+
+def is_mapping(obj):
+    """
+    True if `obj` is a dict, or a lazily computed row.
+    """
+    return isinstance(obj, (dict, LazyDictWithMetadata))
+
+
+def is_reusable(native):
+    """
+    True if a native representation may safely be emitted more than once.
+    Generators can only be consumed once, so anything containing them can't.
+    """
+    if isinstance(native, types.GeneratorType):
+        return False
+    elif is_mapping(native):
+        return all([is_reusable(value) for value in native.itervalues()])
+    elif isinstance(native, (list, tuple)):
+        return all([is_reusable(item) for item in native])
+    return True
+
+
+REFERENCE_KEY = '$ref'
+
+
+def materialise(native):
+    """
+    Evaluate any generators in a native representation, replacing them
+    with lists.
+    """
+    if isinstance(native, types.GeneratorType):
+        return [materialise(item) for item in native]
+    elif is_mapping(native):
+        for key, value in native.items():
+            if isinstance(value, (dict, list, types.GeneratorType)):
+                native[key] = materialise(value)
+    elif isinstance(native, list):
+        native[:] = [materialise(item) for item in native]
+    return native
+
+
+def freeze(native, memo=None):
+    """
+    Return a read-only copy of a native representation, with any generators
+    evaluated into lists, so that it may be shared between renderers, even
+    on other threads.  The representation itself is left unchanged.
+    """
+    if memo is None:
+        memo = {}
+    if is_mapping(native):
+        try:
+            return memo[id(native)]
+        except KeyError:
+            pass
+        frozen = FrozenDictWithMetadata([(key, freeze(value, memo))
+                                         for key, value in native.items()])
+        frozen.metadata = getattr(native, 'metadata', {})
+        if hasattr(native, 'fields'):
+            frozen.fields = native.fields
+        memo[id(native)] = frozen
+        return frozen
+    elif isinstance(native, (list, types.GeneratorType)):
+        return FrozenList([freeze(item, memo) for item in native])
+    return native
+
+
+def resolve_references(data, objects):
+    """
+    Rebuild an object graph from reference-graph output, replacing each
+    `{'$ref': key}` with the object stored against `key` in `objects`.
+    Each distinct object is only resolved once, and is shared between all
+    of the places that reference it.  An object that refers back to itself
+    raises a `DeserializationError`.
+    """
+    resolved = {}
+    in_progress = object()
+
+    def resolve(value):
+        if isinstance(value, dict):
+            if len(value) == 1 and REFERENCE_KEY in value:
+                key = value[REFERENCE_KEY]
+                if key not in resolved:
+                    resolved[key] = in_progress
+                    resolved[key] = resolve(objects[key])
+                elif resolved[key] is in_progress:
+                    raise DeserializationError('Circular reference %r' % key)
+                return resolved[key]
+            return dict([(key, resolve(val)) for key, val in value.items()])
+        elif isinstance(value, list):
+            return [resolve(item) for item in value]
+        return value
+
+    return resolve(data)
+
+
+class IdentityMap(object):
+    """
+    A per-serialization cache of model instances, and of their native
+    representations, keyed on (model, pk).
+
+    Native representations also record every object that was visited while
+    they were being built, so that a cached representation is only reused if
+    converting the object again would not have hit the recursion check.
+
+    Each cache holds at most `max_size` entries, discarding the least
+    recently used, so that streaming a large queryset doesn't keep every
+    nested instance alive.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.instances = collections.OrderedDict()
+        self.natives = collections.OrderedDict()
+        self.visited = []
+        self.depth = 0
+
+    def _get(self, cache, key):
+        value = cache.pop(key, None)
+        if value is not None:
+            cache[key] = value
+        return value
+
+    def _set(self, cache, key, value):
+        cache.pop(key, None)
+        cache[key] = value
+        if len(cache) > self.max_size:
+            cache.popitem(last=False)
+
+    def get_instance(self, model, pk):
+        return self._get(self.instances, (model, pk))
+
+    def add_instance(self, instance):
+        self._set(self.instances, (instance.__class__, instance.pk), instance)
+
+    def visit(self, obj):
+        """
+        Called for every object that is converted, so that we can track the
+        objects that a native representation depends on.
+        """
+        if self.depth:
+            self.visited.append(obj)
+
+    def lookup(self, key, stack):
+        """
+        Return the cached `(instance, native)` pair for `key`, or `None` if
+        there isn't one that is valid for the given recursion stack.
+        """
+        cached = self._get(self.natives, key)
+        if cached is None:
+            return None
+        instance, native, visited = cached
+        for obj in visited:
+            if obj in stack:
+                return None
+        if self.depth:
+            self.visited.extend(visited)
+        return instance, native
+
+    def convert(self, key, instance, convert, stack):
+        """
+        Convert `instance` using the `convert` function, and cache the result
+        against `key`, provided it is safe to reuse.
+        """
+        outer = len(stack)
+        start = len(self.visited)
+        self.depth += 1
+        try:
+            native = convert(instance)
+            visited = self.visited[start:]
+        finally:
+            self.depth -= 1
+            if not self.depth:
+                del self.visited[start:]
+
+        if is_reusable(native) and not [obj for obj in visited if obj in stack[:outer]]:
+            self._set(self.natives, key, (instance, native, visited))
+        return native
+
+
+class Budget(object):
+    """
+    Limits the wall time, number of objects, or number of output bytes used
+    by a serialization.  The limits are checked between top level objects,
+    and at least one object is always emitted, so that each page makes
+    progress.
+    """
+    def __init__(self, max_time=None, max_objects=None, max_bytes=None):
+        self.deadline = None if max_time is None else time.time() + max_time
+        self.max_objects = max_objects
+        self.max_bytes = max_bytes
+        self.objects = 0
+        self.bytes = 0
+        self.last = None
+        self.exhausted = False
+
+    def allows(self):
+        """
+        True if another object may be emitted.
+        """
+        if self.objects and (
+            (self.max_objects is not None and self.objects >= self.max_objects) or
+            (self.max_bytes is not None and self.bytes >= self.max_bytes) or
+            (self.deadline is not None and time.time() >= self.deadline)):
+            self.exhausted = True
+        return not self.exhausted
+
+    def spend(self, obj):
+        """
+        Record that `obj` has been emitted.
+        """
+        self.objects += 1
+        self.last = obj
+
+
+class CountingStream(object):
+    """
+    Wraps an output stream, counting the bytes written to it against a budget.
+    """
+    def __init__(self, stream, budget):
+        self.stream = stream
+        self.budget = budget
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            self.budget.bytes += len(data.encode('utf-8'))
+        else:
+            self.budget.bytes += len(data)
+        self.stream.write(data)
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+
+class BufferedWriter(object):
+    """
+    Wraps an output stream, encoding everything written to it as utf-8 into
+    a reusable buffer, which is written to the stream once it holds
+    `write_size` bytes.  `flush` must be called once writing is done.
+    """
+    def __init__(self, stream, write_size=2 ** 16):
+        self.stream = stream
+        self.write_size = write_size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if not self.buffer and len(data) >= self.write_size:
+            self.stream.write(data)
+            return
+        self.buffer.extend(data)
+        if len(self.buffer) >= self.write_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write(bytes(self.buffer))
+            del self.buffer[:]
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+
+def encode_continuation(position):
+    """
+    Return an opaque, url safe token for a position in a list of objects.
+    """
+    return base64.urlsafe_b64encode(json.dumps(position))
+
+
+def decode_continuation(token):
+    """
+    Return the position encoded by `encode_continuation`.
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid continuation token %r' % token)
+    if not isinstance(position, dict):
+        raise ValueError('Invalid continuation token %r' % token)
+    return position
+
+
+class Base64Payload(object):
+    """
+    The base64 encoded contents of a stored file.
+
+    The file is read and encoded in fixed size chunks as it is rendered,
+    so that the contents are never held in memory all at once.
+    """
+    def __init__(self, storage, name, chunk_size=3 * 2 ** 14):
+        self.storage = storage
+        self.name = name
+        self.chunk_size = chunk_size - chunk_size % 3 or 3
+
+    def chunks(self):
+        """
+        Yield the encoded contents.  Each chunk encodes a multiple of three
+        bytes, so that the chunks may simply be concatenated.
+        """
+        fileobj = self.storage.open(self.name, 'rb')
+        try:
+            pending = ''
+            for data in iter(lambda: fileobj.read(self.chunk_size), ''):
+                pending += data
+                usable = len(pending) - len(pending) % 3
+                if usable:
+                    yield base64.b64encode(pending[:usable])
+                    pending = pending[usable:]
+            if pending:
+                yield base64.b64encode(pending)
+        finally:
+            fileobj.close()
+
+    def __str__(self):
+        return ''.join(self.chunks())
+
+    def __unicode__(self):
+        return unicode(str(self))
+
+
+class Base64ContentFile(File):
+    """
+    A file whose contents are decoded from a base64 string as they are read,
+    a chunk at a time.
+    """
+    def __init__(self, data, name=None):
+        super(Base64ContentFile, self).__init__(None, name)
+        self.data = ''.join(str(data).split())
+        self.size = len(self.data) // 4 * 3 - self.data[-2:].count('=')
+
+    def chunks(self, chunk_size=None):
+        step = (chunk_size or self.DEFAULT_CHUNK_SIZE) // 3 * 4 or 4
+        for start in xrange(0, len(self.data), step):
+            yield base64.b64decode(self.data[start:start + step])
+
+    def multiple_chunks(self, chunk_size=None):
+        return self.size > (chunk_size or self.DEFAULT_CHUNK_SIZE)
+
+
 try:
     import yaml
 except ImportError:
     SafeDumper = None
+    CSafeDumper = None
+    YAMLLoader = None
 else:
     # Adapted from http://pyyaml.org/attachment/ticket/161/use_ordered_dict.py
-    class SafeDumper(yaml.SafeDumper):
+    class OrderedRepresenter(object):
         """
         Handles decimals as strings.
         Handles SortedDicts as usual dicts, but preserves field order, rather
         than the usual behaviour of sorting the keys.
+        Never emits anchors and aliases, as the natives of related objects
+        are shared between every row that references them.
         """
+        def ignore_aliases(self, data):
+            return True
+
         def represent_decimal(self, data):
             return self.represent_scalar('tag:yaml.org,2002:str', str(data))
 
@@ -73,19 +521,100 @@ else:
                     node.flow_style = best_style
             return node
 
-    SafeDumper.add_representer(DictWithMetadata,
-            yaml.representer.SafeRepresenter.represent_dict)
-    SafeDumper.add_representer(SortedDictWithMetadata,
-            yaml.representer.SafeRepresenter.represent_dict)
-    SafeDumper.add_representer(types.GeneratorType,
-            yaml.representer.SafeRepresenter.represent_list)
+    class SafeDumper(OrderedRepresenter, yaml.SafeDumper):
+        pass
+
+    if hasattr(yaml, 'CSafeDumper'):
+        class CSafeDumper(OrderedRepresenter, yaml.CSafeDumper):
+            """
+            `SafeDumper`, emitting with LibYAML.
+            """
+    else:
+        CSafeDumper = None
+
+    for dumper in filter(None, (SafeDumper, CSafeDumper)):
+        dumper.add_representer(decimal.Decimal, OrderedRepresenter.represent_decimal.im_func)
+        dumper.add_representer(SortedDict,
+                yaml.representer.SafeRepresenter.represent_dict)
+        dumper.add_representer(DictWithMetadata,
+                yaml.representer.SafeRepresenter.represent_dict)
+        dumper.add_representer(SortedDictWithMetadata,
+                yaml.representer.SafeRepresenter.represent_dict)
+        dumper.add_representer(LazyDictWithMetadata,
+                yaml.representer.SafeRepresenter.represent_dict)
+        dumper.add_representer(FrozenDictWithMetadata,
+                yaml.representer.SafeRepresenter.represent_dict)
+        dumper.add_representer(FrozenList,
+                yaml.representer.SafeRepresenter.represent_list)
+        dumper.add_representer(types.GeneratorType,
+                yaml.representer.SafeRepresenter.represent_list)
+        dumper.add_representer(Base64Payload,
+                lambda dumper, data: dumper.represent_scalar('tag:yaml.org,2002:str', str(data)))
+
+    try:
+        from yaml.cyaml import CParser
+    except ImportError:
+        YAMLLoader = yaml.SafeLoader
+    else:
+        class YAMLLoader(CParser, yaml.composer.Composer,
+                         yaml.constructor.SafeConstructor, yaml.resolver.Resolver):
+            """
+            A safe loader that parses with LibYAML, but composes nodes in
+            python, so that they may be composed one at a time.
+            """
+            def __init__(self, stream):
+                CParser.__init__(self, stream)
+                yaml.composer.Composer.__init__(self)
+                yaml.constructor.SafeConstructor.__init__(self)
+                yaml.resolver.Resolver.__init__(self)
+
+
+class IteratorList(list):
+    """
+    A list that lazily yields the items of an iterator, so that the pure
+    python JSON encoder can encode it an item at a time.
+
+    The list itself is empty, so this must not be passed to code that reads
+    the list's items directly, such as the C accelerated JSON encoder.
+    """
+    def __init__(self, iterable):
+        super(IteratorList, self).__init__()
+        self.iterator = iter(iterable)
+        try:
+            self.head = [next(self.iterator)]
+        except StopIteration:
+            self.head = []
+
+    def __len__(self):
+        return len(self.head)
+
+    def __iter__(self):
+        return itertools.chain(self.head, self.iterator)
 
 
 class DjangoJSONEncoder(json.JSONEncoder):
     """
     JSONEncoder subclass that knows how to encode date/time and decimal types.
+
+    If the encoder has a `payloads` dictionary, file payloads are encoded as
+    placeholder strings and recorded in it, so that the caller can stream
+    their contents in place of the placeholder.
+
+    If `lazy_lists` is set, iterables are encoded an item at a time as
+    they are consumed, rather than being evaluated into a list first.
+    That only works with `iterencode()`, not `encode()`.
     """
+    payloads = None
+    lazy_lists = False
+
     def default(self, o):
+        if isinstance(o, Base64Payload):
+            if self.payloads is None:
+                return str(o)
+            placeholder = self.encode(u'\x00payload:%d' % len(self.payloads))
+            self.payloads[placeholder] = o
+            return u'\x00payload:%d' % (len(self.payloads) - 1)
+
         # See "Date Time String Format" in the ECMA-262 specification.
         if isinstance(o, datetime.datetime):
             r = o.isoformat()
@@ -105,11 +634,73 @@ class DjangoJSONEncoder(json.JSONEncoder):
             return r
         elif isinstance(o, decimal.Decimal):
             return str(o)
+        elif isinstance(o, LazyDictWithMetadata):
+            return SortedDict(o.items())
         elif hasattr(o, '__iter__'):
+            if self.lazy_lists:
+                return IteratorList(o)
             return [i for i in o]
         return super(DjangoJSONEncoder, self).default(o)
 
 
+class XMLWriter(object):
+    """
+    A faster replacement for `SimplerXMLGenerator`, with the same output.
+
+    Tags are encoded once per element name and cached, and text is encoded
+    as utf-8.  The output is written straight to the stream, which is
+    responsible for any buffering.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        # Written to for every tag, so skip a method call per write.
+        self.write = stream.write
+        self.start_tags = {}
+        self.end_tags = {}
+
+    def startDocument(self):
+        self.write('<?xml version="1.0" encoding="utf-8"?>\n')
+
+    def endDocument(self):
+        pass
+
+    def start_tag(self, name, attrs=None):
+        """
+        Return the encoded start tag for an element.
+        """
+        attrs = u''.join([u' %s=%s' % (key, quoteattr(value))
+                          for key, value in (attrs or {}).items()])
+        return (u'<%s%s>' % (name, attrs)).encode('utf-8')
+
+    def startElement(self, name, attrs=None):
+        if attrs:
+            self.write(self.start_tag(name, attrs))
+            return
+        try:
+            tag = self.start_tags[name]
+        except KeyError:
+            tag = self.start_tags[name] = self.start_tag(name)
+        self.write(tag)
+
+    def endElement(self, name):
+        try:
+            tag = self.end_tags[name]
+        except KeyError:
+            tag = self.end_tags[name] = (u'</%s>' % name).encode('utf-8')
+        self.write(tag)
+
+    def characters(self, content):
+        if not isinstance(content, unicode):
+            content = unicode(content, 'utf-8')
+        self.write(escape(content).encode('utf-8'))
+
+    def addQuickElement(self, name, contents=None, attrs=None):
+        self.startElement(name, attrs)
+        if contents is not None:
+            self.characters(contents)
+        self.endElement(name)
+
+
 class DictWriter(csv.DictWriter):
     """
     >>> from cStringIO import StringIO
@@ -3,8 +3,13 @@ DATABASES = {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': ':memory:',
     },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
 }
 
 INSTALLED_APPS = (
+    'django.contrib.contenttypes',
     'serializers',
 )